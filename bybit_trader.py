@@ -1,8 +1,8 @@
 import asyncio
 import logging
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, List, Optional, Union
 from datetime import datetime
-from pybit.unified_trading import HTTP
+from pybit.unified_trading import HTTP, WebSocket
 import json # Import json for pretty printing
 
 from utils import SecureConfig, safe_api_call # Assuming bybit_rate_limiter is handled within safe_api_call or not globally needed
@@ -38,6 +38,7 @@ class BybitTrader(BaseTrader):
         self._cache_duration = self.config.getint('BYBIT', 'cache_duration_seconds', fallback=5) 
         self._cached_orders: List[Dict] = []
         self._cached_positions: List[Dict] = []
+        self.ws_private: Optional[WebSocket] = None # Private websocket for the position stream (opt-in)
         
         logger.info(f"BybitTrader initialized. Testnet: {self.testnet}, Default Symbol: {self.default_symbol}, Category: {self.trading_category}, AccountType: {self.account_type}")
 
@@ -242,9 +243,13 @@ class BybitTrader(BaseTrader):
             return []
 
 
-    async def get_open_positions(self, symbol: Optional[str] = None, settleCoin: Optional[str] = None) -> List[Dict]:
+    async def get_open_positions(self, symbol: Optional[str] = None, settleCoin: Optional[str] = None, use_cache: bool = True,
+                                 none_on_error: bool = False) -> Optional[List[Dict]]:
+        """Returns the open (size > 0) positions. On failure returns [], or None with none_on_error=True
+        for callers that must not mistake an error for "no positions"."""
+        failed = None if none_on_error else []
         current_time = datetime.now().timestamp()
-        if current_time - self._last_positions_update < self._cache_duration and self._cached_positions:
+        if use_cache and current_time - self._last_positions_update < self._cache_duration and self._cached_positions:
             logger.debug("Returning cached open positions.")
             return self._cached_positions
         try:
@@ -257,18 +262,19 @@ class BybitTrader(BaseTrader):
             response_data, error = await safe_api_call(self.session.get_positions, **params)
             if error:
                 logging.warning(f"Failed to get open positions: {error.get('msg', 'Unknown error')}")
-                return []
+                return failed
             if response_data and response_data.get('retCode') == 0:
                 positions = [p for p in response_data.get('result', {}).get('list', []) if float(p.get('size', '0') or '0') > 0]
-                self._cached_positions = positions; self._last_positions_update = current_time
+                if use_cache: # Cache holds the unfiltered list; filtered/uncached polls must not overwrite it
+                    self._cached_positions = positions; self._last_positions_update = current_time
                 logging.debug(f"Fetched {len(positions)} open positions.")
                 return positions
             ret_msg = response_data.get('retMsg') if response_data else 'No response data'
             logging.warning(f"Failed to get open positions: {ret_msg}. Full: {response_data}")
-            return []
+            return failed
         except Exception as e:
             logger.error(f"Exception in get_open_positions: {e}", exc_info=True)
-            return []
+            return failed
 
     async def place_order(self, symbol: str, side: str, qty: Union[float, str], 
                          order_type: str = "Market", price: Optional[float] = None,
@@ -630,7 +636,29 @@ class BybitTrader(BaseTrader):
             logger.error(f"Exception in get_funding_rate_history: {e}", exc_info=True)
             return None
 
+    def start_position_stream(self, callback: Callable[[Dict], None]) -> bool:
+        """Subscribes to the private 'position' topic. Blocking (connects), and callback runs on pybit's websocket thread."""
+        if self.ws_private:
+            return True
+        try:
+            self.ws_private = WebSocket(testnet=self.testnet, channel_type="private",
+                                        api_key=self.api_key, api_secret=self.api_secret)
+            self.ws_private.position_stream(callback=callback)
+            logger.info("Subscribed to private position stream.")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to start private position stream: {e}", exc_info=True)
+            self.ws_private = None
+            return False
+
+    def stop_position_stream(self):
+        if not self.ws_private:
+            return
+        try: self.ws_private.exit()
+        except Exception as e: logger.warning(f"Error closing private position stream: {e}")
+        self.ws_private = None
+
     async def close(self):
-        logging.info("BybitTrader close called. No explicit async resources to release for pybit HTTP session, but good practice for future.")
-        pass
+        logging.info("BybitTrader close called. Closing the position stream if one is open.")
+        await asyncio.to_thread(self.stop_position_stream) # pybit's exit() joins its websocket thread; keep it off the event loop
 
@@ -164,7 +164,11 @@ class TradingApp:
         self._is_shutting_down: bool = False
         self.settings_window: Optional[tk.Toplevel] = None # To manage settings window
 
+        self.ui_visible: bool = True # Kept current on the Tk thread by <Map>/<Unmap>; the bot thread only reads it
+
         self._create_widgets()
+        self.master.bind('<Map>', self._on_master_map, add='+')
+        self.master.bind('<Unmap>', self._on_master_unmap, add='+')
         self._check_log_queue() # Start polling the log queue
         self.update_status_bar("กำลังเริ่มต้น...", "gray")
         self.update_trading_info_ui() # Initial UI update
@@ -927,6 +931,17 @@ class TradingApp:
             else:
                 self.bybit_status_label.config(text="Bybit: ❌ ยังไม่เชื่อมต่อ", foreground="red") # Thai
 
+    def _on_master_map(self, event):
+        if event.widget is not self.master: # Root bindings also fire for every child widget
+            return
+        self.ui_visible = True
+        if self.trading_bot:
+            self.trading_bot.on_ui_mapped() # Runtime tick stops while hidden
+
+    def _on_master_unmap(self, event):
+        if event.widget is self.master:
+            self.ui_visible = False
+
     def update_runtime_ui(self, runtime_str: str):
         if hasattr(self, 'runtime_label') and self.runtime_label.winfo_exists():
             self.runtime_label.config(text=f"เวลาทำงาน: {runtime_str}") # Thai
@@ -1,5 +1,6 @@
 import re
 from dataclasses import dataclass, field
+from functools import cached_property
 from typing import List, Optional
 from decimal import Decimal, InvalidOperation
 import logging
@@ -16,6 +17,11 @@ class TradingSignal:
     leverage: Optional[int] = None
     # Fields from RICHI Crypto signal example (backtest_days_on, winrate_percentage, etc.) REMOVED
 
+    @cached_property
+    def first_positive_tp(self) -> Optional[Decimal]:
+        """First take-profit above zero, or None. Computed once per signal."""
+        return next((tp for tp in self.take_profits if tp and tp > 0), None)
+
 
 class SignalParser:
     @staticmethod
@@ -1,16 +1,20 @@
 import logging
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal, ROUND_DOWN, ROUND_UP, InvalidOperation
-from typing import Optional, Dict, List, Any, Tuple, Union
+from functools import lru_cache
+from typing import Optional, Dict, List, Any, Tuple, Union, Set, Callable
 import configparser
 import pytz
 import json # Import json for state saving
 import os   # Import os for path manipulation
+import time
+from dataclasses import dataclass, field, fields
 
 from bybit_trader import BybitTrader 
 from telegram_bot import TelegramBot
 from signal_parser import TradingSignal
+from utils import StateFileWriter
 # เพิ่ม import สำหรับ ui_status_log
 try:
     from main import ui_status_log
@@ -31,13 +35,66 @@ TPSL_VERIFICATION_DELAY_SECONDS = 5
 TPSL_VERIFICATION_RETRIES = 3
 TPSL_RETRY_DELAY_SECONDS = 10
 TPSL_PERIODIC_CHECK_INTERVAL_SECONDS = 30 
+POSITION_STREAM_MIN_CYCLE_SECONDS = 1.0 # Minimum spacing between stream-triggered maintenance cycles
+TPSL_RESYNC_TTL_SECONDS = 300 # Re-read exchange TP/SL at least this often even if nothing changed locally
 POSITION_CLOSE_CHECK_INTERVAL_SECONDS = 15 
+PRE_ENTRY_FLAT_TIMEOUT_SECONDS = 3.0 # Max wait for pre-entry closes to show up as flat on the exchange
+PRE_ENTRY_FLAT_POLL_SECONDS = 0.25
+FORMAT_PRICE_CACHE_MAX_ENTRIES = 4096
+INSTRUMENT_INFO_TTL_SECONDS = 3600 # Tick size / qty step change rarely; refresh at most hourly
+POSITIONS_FLUSH_DEBOUNCE_SECONDS = 1.0 # Bursts of position updates within this window are written to disk once
+RUNTIME_TICK_SECONDS = 1.0
+STATE_WRITER_FLUSH_TIMEOUT_SECONDS = 5.0
+UI_ALIVE_CACHE_SECONDS = 1.0 # How long a positive winfo_exists() result is trusted before asking Tk again
+NOW_UTC_CACHE_SECONDS = 0.05 # Timestamps taken within this window share one datetime
 
 # --- State Saving Constants ---
 STATE_DIR = "state" # Directory to store state files
 ACTIVE_POSITIONS_STATE_FILE = os.path.join(STATE_DIR, "active_positions_state.json")
 TRADE_HISTORY_FILE = os.path.join(STATE_DIR, "trade_history.json")
 
+_DEC_ZERO = Decimal(0) # Shared Decimal constants for the sizing/entry hot path
+_DEC_1 = Decimal(1)
+_DEC_100 = Decimal(100)
+
+@lru_cache(maxsize=8192)
+def _dec(value: str) -> Optional[Decimal]:
+    """Parses a numeric API string, treating empty/"0" as None. API strings repeat across polls, so results are memoized."""
+    return Decimal(value) if value and value != "0" else None
+
+def _size_positive(size: Any) -> bool:
+    """True if an API size is > 0. Sizes are unsigned decimal strings, so any non-zero digit means positive (no float parse)."""
+    if isinstance(size, str):
+        return size.strip('0.') != ''
+    return bool(size) and float(size) > 0
+
+@dataclass(slots=True)
+class TrackedPosition:
+    """Bot-side state for one (symbol, positionIdx). Stored in TradingBot.active_positions_details."""
+    symbol: str
+    position_idx: int
+    side: str = '' # "LONG"/"SHORT" from signals, "BUY"/"SELL" from the API; always uppercase
+    entry_price: Optional[Decimal] = None
+    last_known_size: Optional[Decimal] = Decimal(0)
+    signal_entry_price: Optional[Decimal] = None
+    intended_sl: Optional[Decimal] = None
+    intended_tp1: Optional[Decimal] = None
+    tp1_price: Optional[Decimal] = None
+    breakeven_applied: bool = False
+    main_order_id: Optional[str] = None
+    main_order_status: Optional[str] = None
+    tp_order_ids: List[str] = field(default_factory=list)
+    last_update_time: Optional[datetime] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'TrackedPosition':
+        """Builds from a (deserialized) state-file dict, ignoring keys that are no longer fields."""
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in data.items() if k in known})
+
 class BaseTrader:
     def __init__(self, config, exchange_name):
         self.exchange_name = exchange_name
@@ -46,12 +103,21 @@ class BaseTrader:
     # ... ฟังก์ชันหลักๆ เดิม ...
 
 class TradingBot:
+    _ALLOW_MAINT_STATUSES = frozenset({'Filled', 'N/A (External/Synced)'}) # Entry statuses eligible for TP/SL maintenance
+
     def __init__(self, config: configparser.ConfigParser, telegram_code_callback=None, ui_master=None, app_instance=None):
         self.config = config
         self._ui_master = ui_master
         self._app_instance = app_instance
+        self._master_ref = getattr(app_instance, 'master', None) if app_instance else None # Tk root used by all UI guards
+        self._runtime_handle: Optional[asyncio.TimerHandle] = None
+        self._last_runtime_str: Optional[str] = None
+        self._ui_alive_until: float = 0.0 # monotonic deadline until which the UI is assumed alive
+        self._utc_now_cache: Tuple[float, Optional[datetime]] = (0.0, None) # (monotonic taken at, aware UTC datetime)
 
         self.bybit_trader = BybitTrader(self.config)
+        self._default_coin = self.bybit_trader.default_coin # Fixed for the session; read often in the maintenance loop
+        self._trading_category = self.bybit_trader.trading_category
         self.telegram_bot = TelegramBot(
             self.config,
             self.bybit_trader,
@@ -62,32 +128,48 @@ class TradingBot:
 
         self.current_balance: float = 0.0
         self.current_available_balance: float = 0.0
+        self._available_balance_dec: Decimal = Decimal(0) # Decimal mirror of current_available_balance for sizing math
         self.current_margin: float = 0.0
         self.total_orders_count: int = 0
         self.total_positions_count: int = 0
         self.current_open_orders: List[Dict] = []
+        self._open_orders_by_id: Dict[str, Dict] = {} # orderId -> order, kept in step with current_open_orders
         self.current_open_positions: List[Dict] = []
+        self._api_pos_index: Dict[Tuple[str, int], Dict] = {} # Active API positions keyed by (symbol, positionIdx)
         self.instrument_info: Dict[str, Dict[str, Any]] = {}
+        self._instrument_info_ts: Dict[str, float] = {} # symbol -> monotonic time of last fetch attempt
+        self._fmt_price_cache: Dict[Tuple[str, str], Decimal] = {} # (symbol, raw price str) -> formatted Decimal
+        self._last_applied_tpsl: Dict[Tuple[str, int], Tuple[Optional[Decimal], Optional[Decimal], float]] = {} # pos_key -> (tp, sl, monotonic ts) last confirmed on exchange
 
         self.bybit_connected: bool = False
         self.telegram_connected: bool = False
 
-        self.running: bool = False
+        self._running: bool = False # See the running property
         self.loop: Optional[asyncio.AbstractEventLoop] = None
         self.start_time: Optional[datetime] = None
+        self._start_monotonic: Optional[float] = None # Runtime clock; immune to wall-clock jumps
 
         self._periodic_tasks: List[asyncio.Task] = []
         self._shutdown_event = asyncio.Event()
+        self._stop_task: Optional[asyncio.Task] = None # Task running stop(); start() waits for it before returning
+        self._state_writer = StateFileWriter("TradingBotStateWriter") # State files are written off the event loop
+        self._positions_dirty = asyncio.Event() # Set when active_positions_details needs to be flushed to disk
+        self._closed_queue: asyncio.Queue = asyncio.Queue() # (pos_key, tracked_info, closed_position_data, reason_override)
+        self._closed_inflight: Optional[asyncio.Task] = None # Closure the worker is handling; survives worker cancellation
+        self._positions_updated = asyncio.Event() # Set by the websocket position stream when a position opens, closes or changes size/side/avgPrice
+        self._position_stream_active: bool = False
         self.is_license_valid: bool = True
         self.license_days_remaining: int = 365
 
         self.default_qty_precision = self.config.getint('BYBIT', 'default_qty_precision', fallback=3)
         self.default_price_precision = self.config.getint('BYBIT', 'default_price_precision', fallback=1)
         self.position_size_mode = self.config.get('BYBIT', 'position_size_mode', fallback='fixed').lower()
-        self.risk_per_trade_percentage = self.config.getfloat('BYBIT', 'risk_per_trade_percentage', fallback=1.0)
+        self._reload_config()
         self.enable_breakeven_on_tp1 = self.config.getboolean('BYBIT', 'enable_breakeven_on_tp1', fallback=False)
         self.cancel_orders_on_new_signal = self.config.getboolean('BYBIT', 'cancel_orders_on_new_signal', fallback=True)
         self.closed_pnl_fetch_limit = self.config.getint('BYBIT', 'closed_pnl_fetch_limit', fallback=5)
+        self.enable_position_stream = self.config.getboolean('BYBIT', 'enable_position_stream', fallback=False)
+        self._tpsl_sema = asyncio.Semaphore(self.config.getint('BYBIT', 'tpsl_parallelism', fallback=5)) # Max positions maintained concurrently
         self.enable_breakeven_on_partial_tp = True
 
 
@@ -101,28 +183,13 @@ class TradingBot:
 
         # Initialize state variables (will be loaded from disk if files exist)
         self.trade_history: List[Dict[str, Any]] = []
-        self.active_positions_details: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        self.active_positions_details: Dict[Tuple[str, int], TrackedPosition] = {}
         
         self._ensure_state_dir_exists() # Create state directory if it doesn't exist
         self._load_trade_history_from_disk()
         self._load_active_positions_from_disk()
 
-        # Structure of active_positions_details[(symbol, pos_idx)]:
-        # {
-        #     'symbol': str,
-        #     'position_idx': int,
-        #     'side': str ("BUY" or "SELL"),
-        #     'entry_price': Optional[Decimal], 
-        #     'signal_entry_price': Optional[Decimal], 
-        #     'intended_sl': Optional[Decimal],
-        #     'intended_tp1': Optional[Decimal], 
-        #     'breakeven_applied': bool,
-        #     'main_order_id': Optional[str],
-        #     'main_order_status': Optional[str], 
-        #     'tp_order_ids': List[str], 
-        #     'last_update_time': datetime, # Will be stored as ISO string
-        #     'last_known_size': Optional[Decimal] 
-        # }
+        # active_positions_details[(symbol, pos_idx)] -> TrackedPosition (last_update_time is stored as an ISO string)
 
     # --- State Saving and Loading Methods ---
     def _ensure_state_dir_exists(self):
@@ -165,33 +232,28 @@ class TradingBot:
             return {k: self._deserialize_value(v) for k, v in value.items()}
         return value
         
+    def _mark_positions_dirty(self):
+        """Schedules a debounced save of active_positions_details (queued immediately if the flusher is not running)."""
+        if self.running:
+            self._positions_dirty.set()
+        else:
+            self._save_active_positions_to_disk()
+
     def _save_active_positions_to_disk(self):
-        """Saves the active_positions_details to a JSON file."""
-        if not self.active_positions_details:
+        """Queues a save of active_positions_details (snapshotted now, written by the state writer thread)."""
+        snapshot = self._snapshot_active_positions()
+        if snapshot is None:
             logger.debug("No active positions to save.")
-            if os.path.exists(ACTIVE_POSITIONS_STATE_FILE):
-                try:
-                    os.remove(ACTIVE_POSITIONS_STATE_FILE)
-                    logger.info(f"Removed active positions state file as it's now empty: {ACTIVE_POSITIONS_STATE_FILE}")
-                except OSError as e:
-                    logger.error(f"Error removing empty state file {ACTIVE_POSITIONS_STATE_FILE}: {e}")
-            return
-
-        logger.info(f"Saving active positions to {ACTIVE_POSITIONS_STATE_FILE}...")
-        data_to_save = {}
-        for (symbol, pos_idx), details in self.active_positions_details.items():
-            key_str = f"{symbol}_{pos_idx}"
-            data_to_save[key_str] = self._serialize_value(details)
-        
-        try:
-            with open(ACTIVE_POSITIONS_STATE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(data_to_save, f, indent=4)
-            logger.info(f"Successfully saved {len(data_to_save)} active position(s) to disk.")
-        except IOError as e:
-            logger.error(f"Failed to save active positions state: {e}", exc_info=True)
-        except TypeError as e:
-            logger.error(f"TypeError during active positions serialization: {e}. Data: {data_to_save}", exc_info=True)
+        else:
+            logger.info(f"Saving {len(snapshot)} active position(s) to {ACTIVE_POSITIONS_STATE_FILE}...")
+        self._state_writer.enqueue(ACTIVE_POSITIONS_STATE_FILE, snapshot) # None removes the file
 
+    def _snapshot_active_positions(self) -> Optional[Dict[str, Any]]:
+        """Serializes active_positions_details (on the event loop thread). Returns None when there is nothing to save."""
+        if not self.active_positions_details:
+            return None
+        return {f"{symbol}_{pos_idx}": self._serialize_value(details.to_dict())
+                for (symbol, pos_idx), details in self.active_positions_details.items()}
 
     def _load_active_positions_from_disk(self):
         """Loads the active_positions_details from a JSON file."""
@@ -219,10 +281,13 @@ class TradingBot:
                             deserialized_details[field_key] = datetime.fromisoformat(str(field_value)) if field_value else None
                         elif field_key == 'tp_order_ids' and isinstance(field_value, list):
                              deserialized_details[field_key] = [str(item) for item in field_value] 
+                        elif field_key == 'side' and isinstance(field_value, str):
+                            deserialized_details[field_key] = field_value.upper() # Side is kept uppercase everywhere
                         else:
                             deserialized_details[field_key] = field_value 
 
-                    self.active_positions_details[(symbol, pos_idx)] = deserialized_details
+                    deserialized_details.setdefault('symbol', symbol); deserialized_details.setdefault('position_idx', pos_idx)
+                    self.active_positions_details[(symbol, pos_idx)] = TrackedPosition.from_dict(deserialized_details)
                 except ValueError as ve:
                     logger.error(f"Error parsing key '{key_str}' or pos_idx from state file: {ve}")
                 except Exception as e_detail:
@@ -238,21 +303,20 @@ class TradingBot:
 
 
     def _save_trade_history_to_disk(self):
-        """Saves the trade_history to a JSON file."""
+        """Queues a save of trade_history to its JSON file."""
         if not self.trade_history:
             logger.debug("No trade history to save.")
             return
 
         logger.info(f"Saving trade history to {TRADE_HISTORY_FILE}...")
-        data_to_save = [self._serialize_value(item) for item in self.trade_history]
-        try:
-            with open(TRADE_HISTORY_FILE, 'w', encoding='utf-8') as f:
-                json.dump(data_to_save, f, indent=4)
-            logger.info(f"Successfully saved {len(data_to_save)} trade history entries to disk.")
-        except IOError as e:
-            logger.error(f"Failed to save trade history: {e}", exc_info=True)
-        except TypeError as e:
-            logger.error(f"TypeError during trade history serialization: {e}. Data sample: {data_to_save[:2] if data_to_save else 'N/A'}", exc_info=True)
+        data_to_save = [self._serialize_value(item) for item in self.trade_history] # Snapshot on the caller's thread
+        self._state_writer.enqueue(TRADE_HISTORY_FILE, data_to_save)
+
+    async def _flush_state_to_disk(self):
+        """Queues final saves of positions and history and waits (off the loop) for the writer to finish them."""
+        self._save_active_positions_to_disk()
+        self._save_trade_history_to_disk()
+        await asyncio.to_thread(self._state_writer.flush_and_join, STATE_WRITER_FLUSH_TIMEOUT_SECONDS)
 
 
     def _load_trade_history_from_disk(self):
@@ -277,8 +341,17 @@ class TradingBot:
 
     # --- End of State Saving and Loading Methods ---
 
+    def _now_utc(self) -> datetime:
+        """Timezone-aware UTC now, reused for NOW_UTC_CACHE_SECONDS so bursts of updates share one timestamp."""
+        mono = time.monotonic()
+        taken_at, cached = self._utc_now_cache
+        if cached is None or mono - taken_at >= NOW_UTC_CACHE_SECONDS:
+            cached = datetime.now(timezone.utc)
+            self._utc_now_cache = (mono, cached)
+        return cached
+
     def _add_trade_to_history(self, symbol: str, order_type: str, side: str, qty: str, price: Optional[str], order_id: Optional[str], status: str, pnl: Optional[str] = "0.00", notes: Optional[str] = None):
-        now_utc = datetime.utcnow()
+        now_utc = self._now_utc()
         now_thailand = now_utc.astimezone(THAILAND_TZ)
         trade_event = {
             "time": now_thailand.strftime("%Y-%m-%d %H:%M:%S"), 
@@ -294,9 +367,7 @@ class TradingBot:
         self.trade_history.append(trade_event)
         logger.info(f"Trade history updated: {trade_event}")
         self._save_trade_history_to_disk() 
-        if self._app_instance and hasattr(self._app_instance, '_update_orders_positions_table'):
-            if self._app_instance.master and hasattr(self._app_instance.master, 'winfo_exists') and self._app_instance.master.winfo_exists():
-                 self._app_instance.master.after(0, self._app_instance._update_orders_positions_table)
+        self._ui_post('_update_orders_positions_table')
 
     def get_formatted_trade_history(self) -> List[Tuple[str, str, str, str, str, str]]:
         logger.debug(f"get_formatted_trade_history: Current self.trade_history length: {len(self.trade_history)}. List ID: {id(self.trade_history)}")
@@ -323,6 +394,22 @@ class TradingBot:
         logger.debug(f"get_formatted_trade_history: Returning {len(formatted_history)} formatted items.")
         return formatted_history[:50] 
 
+    def _set_open_orders(self, orders: List[Dict]):
+        """Assigns current_open_orders and rebuilds the orderId index used by reconcile."""
+        self.current_open_orders = orders
+        self._open_orders_by_id = {o.get('orderId'): o for o in orders if o.get('orderId')}
+
+    @staticmethod
+    def _is_active_position(p: Dict) -> bool:
+        """True if an API position has a non-zero size."""
+        return _size_positive(p.get('size'))
+
+    @staticmethod
+    def _index_positions(positions: List[Dict]) -> Dict[Tuple[str, int], Dict]:
+        """Indexes active (non-zero size) API positions by (symbol, positionIdx) for O(1) lookups."""
+        return {(p.get('symbol'), p.get('positionIdx', 0)): p for p in positions
+                if p.get('symbol') and TradingBot._is_active_position(p)}
+
     def _get_instrument_detail(self, symbol: str, detail_key: str, fallback: Any = None) -> Any:
         return self.instrument_info.get(symbol, {}).get(detail_key, fallback)
 
@@ -333,6 +420,8 @@ class TradingBot:
             if qty_step_str:
                 qty_step = Decimal(qty_step_str)
                 if qty_step > Decimal(0):
+                    if num_quantity % qty_step == 0: # Already on the step grid; only the exponent needs aligning
+                        return str(num_quantity.quantize(qty_step))
                     formatted_qty_decimal = (num_quantity / qty_step).quantize(Decimal('1'), rounding=ROUND_DOWN) * qty_step
                     return str(formatted_qty_decimal.quantize(qty_step, rounding=ROUND_DOWN))
             precision = self.config.getint('BYBIT', f"{symbol.upper()}_qty_precision", fallback=self.default_qty_precision)
@@ -352,6 +441,8 @@ class TradingBot:
             if price_step_str:
                 price_step = Decimal(price_step_str)
                 if price_step > Decimal(0):
+                    if num_price % price_step == 0: # Already on the tick grid; only the exponent needs aligning
+                        return str(num_price.quantize(price_step))
                     formatted_price_decimal = (num_price / price_step).quantize(Decimal('1'), rounding=ROUND_DOWN) * price_step
                     return str(formatted_price_decimal.quantize(price_step, rounding=ROUND_DOWN)) 
             precision = self.config.getint('BYBIT', f"{symbol.upper()}_price_precision", fallback=self.default_price_precision)
@@ -364,8 +455,20 @@ class TradingBot:
                 return f"{float(price):.{precision}f}"
             except: return str(price)
 
+    def _format_price_decimal(self, price: Union[Decimal, str], symbol: str) -> Decimal:
+        """Memoized Decimal(self._format_price(price, symbol)). Cleared whenever instrument info is (re)fetched."""
+        cache_key = (symbol, str(price))
+        formatted = self._fmt_price_cache.get(cache_key)
+        if formatted is None:
+            if len(self._fmt_price_cache) >= FORMAT_PRICE_CACHE_MAX_ENTRIES:
+                self._fmt_price_cache.clear()
+            formatted = Decimal(self._format_price(price, symbol))
+            self._fmt_price_cache[cache_key] = formatted
+        return formatted
+
     async def _fetch_and_store_instrument_info(self, symbol: str):
-        if symbol in self.instrument_info and self.instrument_info[symbol].get('tickSize') and self.instrument_info[symbol].get('qtyStep'):
+        if symbol in self.instrument_info and self.instrument_info[symbol].get('tickSize') and self.instrument_info[symbol].get('qtyStep') \
+                and time.monotonic() - self._instrument_info_ts.get(symbol, 0.0) < INSTRUMENT_INFO_TTL_SECONDS:
             logger.debug(f"Instrument info for {symbol} already exists and seems complete. Skipping fetch.")
             return
         try:
@@ -396,13 +499,73 @@ class TradingBot:
                     'tickSize': self.config.get('BYBIT', f"{symbol.upper()}_price_step", fallback=str(Decimal('1e-' + str(self.default_price_precision)))),
                 }
                  logger.info(f"Using fallback instrument info for {symbol} due to exception: {self.instrument_info[symbol]}")
+        self._instrument_info_ts[symbol] = time.monotonic() # Also on fallback, so a failing API is retried once per TTL
+        self._fmt_price_cache.clear() # Tick size may have changed
 
 
+    def _ui_alive(self) -> bool:
+        """Returns True if the Tk master window still exists. A positive result is memoized for UI_ALIVE_CACHE_SECONDS."""
+        now = time.monotonic()
+        if now < self._ui_alive_until:
+            return True
+        master = self._master_ref
+        try:
+            alive = master is not None and bool(master.winfo_exists())
+        except Exception: # Tk root already destroyed
+            alive = False
+        if alive:
+            self._ui_alive_until = now + UI_ALIVE_CACHE_SECONDS
+        return alive
+
+    def _ui_visible(self) -> bool:
+        """True if the Tk window exists and is mapped. The app tracks <Map>/<Unmap> on the Tk thread; this only reads its flag."""
+        return self._ui_alive() and getattr(self._app_instance, 'ui_visible', True)
+
+    def on_ui_mapped(self):
+        """Called from the Tk thread when the window is shown again: restarts the runtime tick if it had stopped."""
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._resume_runtime_tick)
+        except RuntimeError: # Loop closed in between
+            pass
+
+    def _resume_runtime_tick(self):
+        if self._runtime_handle is None and self.running and self.start_time and not self._shutdown_event.is_set():
+            self._schedule_runtime_tick(0)
+
+    def _apply_stopped_ui(self):
+        """Runs on the Tk thread: every stopped-state refresh in one pass."""
+        app = self._app_instance
+        app.update_trading_info_ui()
+        app.update_bybit_status_ui(False)
+        app.update_telegram_status_ui(False)
+        app.update_status_bar("Bot Stopped", "gray")
+
+    def _apply_signal_entry_ui(self, order_msg: str, status_text: str):
+        """Runs on the Tk thread: logs the incoming order block and shows the processing status together."""
+        ui_status_log(order_msg)
+        self._app_instance.update_status_bar(status_text, "orange")
+
+    def _ui_post(self, callback: Union[str, Callable], *args):
+        """Schedules app.<callback>(*args) (or callback(*args) for a callable) on the Tk thread if the UI is still alive."""
+        if not self._ui_alive():
+            return
+        if isinstance(callback, str):
+            callback = getattr(self._app_instance, callback, None)
+            if callback is None: # App without this hook; not a sign the window is gone
+                return
+        try:
+            self._master_ref.after(0, callback, *args)
+        except Exception as e: # Window destroyed within the memoization window
+            self._ui_alive_until = 0.0
+            logger.debug(f"UI update skipped, Tk master no longer available: {e}")
+
     async def _check_license(self) -> bool: 
         self.is_license_valid = True 
         self.license_days_remaining = 30 
-        if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-            self._app_instance.master.after(0, lambda: self._app_instance.update_license_info("Valid (Demo)", "30")) 
+        self._ui_post('update_license_info', "Valid (Demo)", "30")
         return True
 
     async def _get_closed_pnl_for_symbol(self, symbol: str, limit: int = 1) -> List[Dict]:
@@ -430,24 +593,55 @@ class TradingBot:
             logger.error(f"Error fetching closed PnL for {symbol}: {e}", exc_info=True)
         return []
 
-    async def _handle_closed_position(self, pos_key: Tuple[str, int], closed_position_data: Optional[Dict] = None, reason_override: Optional[str] = None):
+    def _enqueue_closed_position(self, pos_key: Tuple[str, int], closed_position_data: Optional[Dict] = None, reason_override: Optional[str] = None):
+        """Stops tracking pos_key right away and hands the closure side-effects (history, Telegram, UI) to _closed_position_worker."""
+        tracked_info = self.active_positions_details.pop(pos_key, None)
+        self._last_applied_tpsl.pop(pos_key, None)
+        self._mark_positions_dirty()
+        if not tracked_info:
+            logger.warning(f"No tracking information found for closed position {pos_key[0]} (PosIdx: {pos_key[1]}) when trying to handle closure.")
+            return
+        self._closed_queue.put_nowait((pos_key, tracked_info, closed_position_data, reason_override))
+
+    async def _closed_position_worker(self):
+        try:
+            while True:
+                item = await self._closed_queue.get()
+                # Shielded: tracking is already popped, so a closure cancelled mid-way would lose its side-effects.
+                # _cleanup_tasks awaits whatever is still in flight.
+                self._closed_inflight = asyncio.ensure_future(self._process_closed_item(item))
+                await asyncio.shield(self._closed_inflight)
+        except asyncio.CancelledError: logger.info("Closed position worker task cancelled.")
+
+    async def _process_closed_item(self, item: Tuple):
+        pos_key, tracked_info, closed_position_data, reason_override = item
+        try:
+            await self._handle_closed_position(pos_key, closed_position_data, reason_override, tracked_info=tracked_info)
+        except Exception as e:
+            logger.error(f"Error handling closed position {pos_key}: {e}", exc_info=True)
+        finally:
+            self._closed_queue.task_done()
+
+    async def _handle_closed_position(self, pos_key: Tuple[str, int], closed_position_data: Optional[Dict] = None, reason_override: Optional[str] = None,
+                                      tracked_info: Optional[TrackedPosition] = None):
         symbol, position_idx = pos_key
         
-        tracked_info = self.active_positions_details.pop(pos_key, None) 
+        if tracked_info is None: # Not pre-popped by _enqueue_closed_position
+            tracked_info = self.active_positions_details.pop(pos_key, None) 
+            self._last_applied_tpsl.pop(pos_key, None)
+            self._mark_positions_dirty() 
         if not tracked_info:
             logger.warning(f"No tracking information found for closed position {symbol} (PosIdx: {position_idx}) when trying to handle closure.")
-            self._save_active_positions_to_disk() 
             return
 
         logger.info(f"Handling closed position for {symbol} (PosIdx: {position_idx}). Tracked info: {tracked_info}")
-        self._save_active_positions_to_disk() 
 
         reason_note = reason_override or "Position Closed (Reason Undetermined)"
         pnl_value = "N/A" 
         exit_price_str = "N/A" 
         
-        pos_side = tracked_info.get('side', 'N/A')
-        qty_closed = closed_position_data.get('size', tracked_info.get('last_known_size', 'N/A')) if closed_position_data else tracked_info.get('last_known_size', 'N/A')
+        pos_side = tracked_info.side or 'N/A'
+        qty_closed = closed_position_data.get('size', tracked_info.last_known_size) if closed_position_data else tracked_info.last_known_size
 
         logger.info(f"Position {symbol} (PosIdx: {position_idx}) determined closed. Reason: {reason_note}. PnL: {pnl_value}, Exit: {exit_price_str}")
         self._add_trade_to_history(symbol, "System Close", pos_side, str(qty_closed),
@@ -463,40 +657,32 @@ class TradingBot:
             except Exception as e_tg_send:
                 logger.error(f"Failed to send Telegram notification for closed position {symbol}: {e_tg_send}")
         
-        if pos_key in self.active_positions_details: 
-            del self.active_positions_details[pos_key]
-            logger.info(f"Re-confirmed removal of details for closed position: {symbol} (PosIdx: {position_idx})")
-            self._save_active_positions_to_disk() 
-
         # --- หลังปิดออเดอร์ เรียกอัปเดต UI ---
-        if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-            self._app_instance.master.after(0, self._app_instance.update_trading_info_ui)
+        self._ui_post('update_trading_info_ui')
 
 
     async def update_initial_trading_data(self):
         logger.info("TradingBot: Updating trading data (with improved reconciliation)...")
         if not self.bybit_trader:
             logger.error("TradingBot: BybitTrader not initialized."); self.bybit_connected = False
-            if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-                 self._app_instance.master.after(0, lambda: self._app_instance.update_bybit_status_ui(False))
+            self._ui_post('update_bybit_status_ui', False)
             return
 
         self.bybit_connected = await self.bybit_trader.test_connection()
-        if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-            self._app_instance.master.after(0, lambda: self._app_instance.update_bybit_status_ui(self.bybit_connected))
+        self._ui_post('update_bybit_status_ui', self.bybit_connected)
 
         if self.bybit_connected:
             if not self.instrument_info.get(self.target_trading_symbol): 
                 await self._fetch_and_store_instrument_info(self.target_trading_symbol)
 
-            balance_task = self.bybit_trader.get_wallet_balance(self.bybit_trader.account_type, self.bybit_trader.default_coin)
-            orders_task = self.bybit_trader.get_open_orders(settleCoin=self.bybit_trader.default_coin) # Fetch all open orders for the settle coin
-            positions_task = self.bybit_trader.get_open_positions(settleCoin=self.bybit_trader.default_coin) # Fetch all open positions
+            balance_task = self.bybit_trader.get_wallet_balance(self.bybit_trader.account_type, self._default_coin)
+            orders_task = self.bybit_trader.get_open_orders(settleCoin=self._default_coin) # Fetch all open orders for the settle coin
+            positions_task = self.bybit_trader.get_open_positions(settleCoin=self._default_coin) # Fetch all open positions
 
             results = await asyncio.gather(balance_task, orders_task, positions_task, return_exceptions=True)
 
             balance_data = results[0] if not isinstance(results[0], Exception) else None
-            self.current_open_orders = results[1] if not isinstance(results[1], Exception) else [] # Store all open orders
+            self._set_open_orders(results[1] if not isinstance(results[1], Exception) else []) # Store all open orders
             new_positions_list_from_api = results[2] if not isinstance(results[2], Exception) else [] # Store all open positions
             
             if isinstance(results[0], Exception): logger.error(f"Error fetching balance: {results[0]}")
@@ -506,174 +692,193 @@ class TradingBot:
             if balance_data:
                 self.current_balance = float(balance_data.get('total_balance', 0.0))
                 self.current_available_balance = float(balance_data.get('available_balance', 0.0))
+                self._available_balance_dec = Decimal(str(self.current_available_balance))
                 self.current_margin = float(balance_data.get('used_margin', 0.0))
-            else: self.current_balance = self.current_available_balance = self.current_margin = 0.0
+            else:
+                self.current_balance = self.current_available_balance = self.current_margin = 0.0
+                self._available_balance_dec = Decimal(0)
             logger.info(f"TradingBot: Balance - Total: {self.current_balance:.2f}, Avail: {self.current_available_balance:.2f}, Margin: {self.current_margin:.2f}")
 
             self.total_orders_count = len(self.current_open_orders)
             
             # --- Improved Reconciliation Logic ---
-            previous_tracked_pos_keys = set(self.active_positions_details.keys())
-            current_api_pos_keys = set() # Positions currently active on Bybit
-
-            # 1. Update status of tracked main orders and sync existing positions from API
-            for pos_key_tracked, details_tracked in list(self.active_positions_details.items()):
+            self._api_pos_index = self._index_positions(new_positions_list_from_api)
+            tracked_keys = set(self.active_positions_details)
+            api_keys = set(self._api_pos_index) # Positions currently active on Bybit
+            still_active = tracked_keys & api_keys
+            closed_tracked = tracked_keys - api_keys
+            new_untracked = api_keys - tracked_keys
+            now_utc = self._now_utc() # One timestamp per reconcile cycle
+
+            # 1. Sync tracked positions that are still active on the API
+            for pos_key_tracked in still_active:
                 symbol_tracked, pos_idx_tracked = pos_key_tracked
-                main_order_id = details_tracked.get('main_order_id')
-                current_tracked_status = details_tracked.get('main_order_status')
-
-                # Check if this tracked position is active on the API
-                pos_on_api = next((p for p in new_positions_list_from_api if p.get('symbol') == symbol_tracked and p.get('positionIdx') == pos_idx_tracked and float(p.get('size','0')) > 0), None)
-
-                if pos_on_api: # Position is active on API
-                    current_api_pos_keys.add(pos_key_tracked) # Mark as active on API
-                    live_avg_price_str = pos_on_api.get('avgPrice')
-                    live_avg_price = Decimal(live_avg_price_str) if live_avg_price_str and live_avg_price_str != "0" else None
-                    live_side = pos_on_api.get('side','').upper()
-                    live_size_str = pos_on_api.get('size', '0')
-                    live_size = Decimal(live_size_str) if live_size_str else Decimal(0)
-                    live_sl = Decimal(pos_on_api.get('stopLoss', '0')) if pos_on_api.get('stopLoss') and pos_on_api.get('stopLoss') != "0" else None
-                    live_tp = Decimal(pos_on_api.get('takeProfit', '0')) if pos_on_api.get('takeProfit') and pos_on_api.get('takeProfit') != "0" else None
-
-                    if details_tracked.get('entry_price') != live_avg_price and live_avg_price:
-                        logger.info(f"Updating entry price for {symbol_tracked} (Idx {pos_idx_tracked}) from {details_tracked.get('entry_price')} to {live_avg_price}")
-                        details_tracked['entry_price'] = live_avg_price
-                    if details_tracked.get('side') != live_side and live_side:
-                        logger.warning(f"Side mismatch for {symbol_tracked} (Idx {pos_idx_tracked}): Tracked={details_tracked.get('side')}, API={live_side}. Updating.")
-                        details_tracked['side'] = live_side
-                    if details_tracked.get('last_known_size') != live_size:
-                         logger.info(f"Updating size for {symbol_tracked} (Idx {pos_idx_tracked}) from {details_tracked.get('last_known_size')} to {live_size}")
-                         details_tracked['last_known_size'] = live_size
-                    
-                    # Sync SL/TP if they were not intentionally set by bot or if BE was applied
-                    if details_tracked.get('intended_sl') is None or details_tracked.get('breakeven_applied'):
-                        if details_tracked.get('intended_sl') != live_sl:
-                             logger.info(f"Syncing SL for {symbol_tracked} (Idx {pos_idx_tracked}) from exchange: {live_sl} (was {details_tracked.get('intended_sl')})")
-                             details_tracked['intended_sl'] = live_sl
-                    if details_tracked.get('intended_tp1') is None:
-                         if details_tracked.get('intended_tp1') != live_tp:
-                             logger.info(f"Syncing TP1 for {symbol_tracked} (Idx {pos_idx_tracked}) from exchange: {live_tp} (was {details_tracked.get('intended_tp1')})")
-                             details_tracked['intended_tp1'] = live_tp
-
-                    if current_tracked_status != 'Filled': # If position is active, main order must have filled
-                        logger.info(f"Confirming main order status as 'Filled' for {symbol_tracked} (Idx {pos_idx_tracked}) due to active position on API.")
-                        details_tracked['main_order_status'] = 'Filled'
-                    details_tracked['last_update_time'] = datetime.utcnow()
-
-                else: # Tracked position is NOT active on API
-                    if main_order_id and current_tracked_status not in ['Filled', 'Cancelled', 'Rejected', 'Deactivated']:
-                        # Order was pending, check if the order itself is still open
-                        order_on_exchange = next((o for o in self.current_open_orders if o.get('orderId') == main_order_id), None)
-                        if order_on_exchange:
-                            new_status_from_api = order_on_exchange.get('orderStatus')
-                            if current_tracked_status != new_status_from_api:
-                                logger.info(f"Tracked position {symbol_tracked} (Idx {pos_idx_tracked}) not active on API, but main order {main_order_id} is still '{new_status_from_api}'. Updating status.")
-                                details_tracked['main_order_status'] = new_status_from_api
-                                details_tracked['last_update_time'] = datetime.utcnow()
-                            # If order is still open (e.g. New, PartiallyFilled), we keep tracking it. It's not "closed" yet.
-                        else:
-                            # Order was pending, no active position, and order is no longer in open orders.
-                            # This implies the entry order failed (Cancelled/Rejected by exchange or user).
-                            logger.info(f"Tracked position {symbol_tracked} (Idx {pos_idx_tracked}) not active on API, and main order {main_order_id} (was: {current_tracked_status}) no longer open. Handling as entry failed/cancelled.")
-                            await self._handle_closed_position(pos_key_tracked, reason_override="Entry Order Failed/Cancelled")
-                    
-                    elif current_tracked_status == 'Filled':
-                        # Position was 'Filled' but now absent from API's active positions. This means it's genuinely closed.
-                        logger.info(f"Position {symbol_tracked} (Idx {pos_idx_tracked}) was 'Filled' but no longer in API's open positions. Handling as closed on exchange.")
-                        await self._handle_closed_position(pos_key_tracked, reason_override="Closed on Exchange (was Filled)")
-                    
-                    else: # e.g. status was already Cancelled/Rejected, or other unhandled states
-                        logger.info(f"Tracked details for {symbol_tracked} (Idx {pos_idx_tracked}) (status: {current_tracked_status}) indicate it's not an active API position. Finalizing cleanup if still tracked.")
-                        if pos_key_tracked in self.active_positions_details: # Check if not already removed by a call above
-                            await self._handle_closed_position(pos_key_tracked, reason_override=f"Cleanup (Status: {current_tracked_status})")
-
-
-            # 2. Add any new positions found on API that were not previously tracked (e.g. external positions)
-            for pos_data_api in new_positions_list_from_api:
-                symbol_api = pos_data_api.get('symbol')
-                pos_idx_api = pos_data_api.get('positionIdx', 0)
-                if not symbol_api or float(pos_data_api.get('size','0')) <= 0: continue # Skip if no symbol or zero size
-
-                api_pos_key = (symbol_api, pos_idx_api)
-                if api_pos_key not in self.active_positions_details: # New, untracked position found on API
-                    current_api_pos_keys.add(api_pos_key) # Mark as active
-                    live_avg_price_str = pos_data_api.get('avgPrice')
-                    live_avg_price = Decimal(live_avg_price_str) if live_avg_price_str and live_avg_price_str != "0" else None
-                    live_side = pos_data_api.get('side','').upper()
-                    live_size_str = pos_data_api.get('size', '0')
-                    live_size = Decimal(live_size_str) if live_size_str else Decimal(0)
-                    live_sl = Decimal(pos_data_api.get('stopLoss', '0')) if pos_data_api.get('stopLoss') and pos_data_api.get('stopLoss') != "0" else None
-                    live_tp = Decimal(pos_data_api.get('takeProfit', '0')) if pos_data_api.get('takeProfit') and pos_data_api.get('takeProfit') != "0" else None
-                    
-                    logger.warning(f"Untracked active position found on exchange: {symbol_api} (Idx {pos_idx_api}, Size {live_size}). Syncing.")
-                    self.active_positions_details[api_pos_key] = {
-                        'symbol': symbol_api, 'position_idx': pos_idx_api, 'side': live_side,
-                        'entry_price': live_avg_price, 'last_known_size': live_size,
-                        'signal_entry_price': None, 
-                        'intended_sl': live_sl, 
-                        'intended_tp1': live_tp, 
-                        'tp1_price': live_tp, # Assuming exchange TP is TP1 for external
-                        'breakeven_applied': False, 
-                        'main_order_id': None, 'main_order_status': 'Filled (External/Synced)', # Assume filled if active
-                        'tp_order_ids': [], 'last_update_time': datetime.utcnow()
-                    }
+                details_tracked = self.active_positions_details[pos_key_tracked]
+                current_tracked_status = details_tracked.main_order_status
+                pos_on_api = self._api_pos_index[pos_key_tracked]
+                live_avg_price = _dec(pos_on_api.get('avgPrice') or "")
+                live_side = (pos_on_api.get('side') or '').upper()
+                live_size = _dec(pos_on_api.get('size') or "") or Decimal(0)
+                live_sl = _dec(pos_on_api.get('stopLoss') or "")
+                live_tp = _dec(pos_on_api.get('takeProfit') or "")
+
+                updates = {}
+                if live_avg_price and details_tracked.entry_price != live_avg_price:
+                    updates['entry_price'] = live_avg_price
+                if live_side and details_tracked.side != live_side:
+                    logger.warning(f"Side mismatch for {symbol_tracked} (Idx {pos_idx_tracked}): Tracked={details_tracked.side}, API={live_side}. Updating.")
+                    updates['side'] = live_side
+                if details_tracked.last_known_size != live_size:
+                    updates['last_known_size'] = live_size
+
+                last_applied = self._last_applied_tpsl.get(pos_key_tracked)
+                if last_applied and (last_applied[0], last_applied[1]) != (live_tp, live_sl):
+                    self._last_applied_tpsl.pop(pos_key_tracked, None) # Exchange TP/SL changed behind our back; force a re-verify
+
+                # Sync SL/TP if they were not intentionally set by bot or if BE was applied
+                tracked_sl = details_tracked.intended_sl
+                if (tracked_sl is None or details_tracked.breakeven_applied) and tracked_sl != live_sl:
+                    updates['intended_sl'] = live_sl
+                if details_tracked.intended_tp1 is None and live_tp is not None:
+                    updates['intended_tp1'] = live_tp
+                if current_tracked_status != 'Filled': # If position is active, main order must have filled
+                    updates['main_order_status'] = 'Filled'
+
+                if updates:
+                    logger.info("Syncing %s (Idx %s) from exchange: %s", symbol_tracked, pos_idx_tracked, updates)
+                    for field_name, value in updates.items(): setattr(details_tracked, field_name, value)
+                details_tracked.last_update_time = now_utc
+
+            # 2. Tracked positions that are NOT active on the API: pending entries or closures
+            for pos_key_tracked in closed_tracked:
+                symbol_tracked, pos_idx_tracked = pos_key_tracked
+                details_tracked = self.active_positions_details[pos_key_tracked]
+                main_order_id = details_tracked.main_order_id
+                current_tracked_status = details_tracked.main_order_status
+                if main_order_id and current_tracked_status not in ['Filled', 'Cancelled', 'Rejected', 'Deactivated']:
+                    # Order was pending, check if the order itself is still open
+                    order_on_exchange = self._open_orders_by_id.get(main_order_id)
+                    if order_on_exchange:
+                        new_status_from_api = order_on_exchange.get('orderStatus')
+                        if current_tracked_status != new_status_from_api:
+                            logger.info(f"Tracked position {symbol_tracked} (Idx {pos_idx_tracked}) not active on API, but main order {main_order_id} is still '{new_status_from_api}'. Updating status.")
+                            details_tracked.main_order_status = new_status_from_api
+                            details_tracked.last_update_time = now_utc
+                        # If order is still open (e.g. New, PartiallyFilled), we keep tracking it. It's not "closed" yet.
+                    else:
+                        # Order was pending, no active position, and order is no longer in open orders.
+                        # This implies the entry order failed (Cancelled/Rejected by exchange or user).
+                        logger.info(f"Tracked position {symbol_tracked} (Idx {pos_idx_tracked}) not active on API, and main order {main_order_id} (was: {current_tracked_status}) no longer open. Handling as entry failed/cancelled.")
+                        self._enqueue_closed_position(pos_key_tracked, reason_override="Entry Order Failed/Cancelled")
+                
+                elif current_tracked_status == 'Filled':
+                    # Position was 'Filled' but now absent from API's active positions. This means it's genuinely closed.
+                    logger.info(f"Position {symbol_tracked} (Idx {pos_idx_tracked}) was 'Filled' but no longer in API's open positions. Handling as closed on exchange.")
+                    self._enqueue_closed_position(pos_key_tracked, reason_override="Closed on Exchange (was Filled)")
+                
+                else: # e.g. status was already Cancelled/Rejected, or other unhandled states
+                    logger.info(f"Tracked details for {symbol_tracked} (Idx {pos_idx_tracked}) (status: {current_tracked_status}) indicate it's not an active API position. Finalizing cleanup if still tracked.")
+                    if pos_key_tracked in self.active_positions_details: # Check if not already removed by a call above
+                        self._enqueue_closed_position(pos_key_tracked, reason_override=f"Cleanup (Status: {current_tracked_status})")
+
+
+            # 3. Add any new positions found on API that were not previously tracked (e.g. external positions)
+            for api_pos_key in new_untracked:
+                symbol_api, pos_idx_api = api_pos_key
+                pos_data_api = self._api_pos_index[api_pos_key]
+                live_avg_price_str = pos_data_api.get('avgPrice')
+                live_avg_price = _dec(live_avg_price_str or "")
+                live_side = (pos_data_api.get('side') or '').upper()
+                live_size = _dec(pos_data_api.get('size') or "") or Decimal(0)
+                live_sl = _dec(pos_data_api.get('stopLoss') or "")
+                live_tp = _dec(pos_data_api.get('takeProfit') or "")
+                
+                logger.warning(f"Untracked active position found on exchange: {symbol_api} (Idx {pos_idx_api}, Size {live_size}). Syncing.")
+                self.active_positions_details[api_pos_key] = TrackedPosition(
+                    symbol=symbol_api, position_idx=pos_idx_api, side=live_side,
+                    entry_price=live_avg_price, last_known_size=live_size,
+                    intended_sl=live_sl,
+                    intended_tp1=live_tp,
+                    tp1_price=live_tp, # Assuming exchange TP is TP1 for external
+                    main_order_status='Filled (External/Synced)', # Assume filled if active
+                    last_update_time=now_utc
+                )
             
             self.current_open_positions = new_positions_list_from_api # Update bot's view of current positions
-            self.total_positions_count = len([p for p in self.current_open_positions if float(p.get('size','0')) > 0]) # Count only active ones
+            self.total_positions_count = len(self._api_pos_index) # Index holds only active ones
 
-            if previous_tracked_pos_keys != set(self.active_positions_details.keys()):
-                self._save_active_positions_to_disk()
+            if closed_tracked or new_untracked:
+                self._mark_positions_dirty()
             # --- End of Improved Reconciliation Logic ---
 
         else: 
             self.current_balance = self.current_available_balance = self.current_margin = 0.0
+            self._available_balance_dec = Decimal(0)
             self.total_orders_count = self.total_positions_count = 0
             logger.warning("Bybit not connected. Cannot update live trading data. Retaining last known state for active positions.")
 
-        if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-            self._app_instance.master.after(0, self._app_instance.update_trading_info_ui)
+        self._ui_post('update_trading_info_ui')
 
 
+    def _reload_config(self):
+        """Snapshots the settings read on every signal into typed attributes. Called at construction and on each start()."""
+        self.risk_per_trade_percentage = self.config.getfloat('BYBIT', 'risk_per_trade_percentage', fallback=1.0)
+        self._risk_frac_dec = Decimal(str(self.risk_per_trade_percentage)) / Decimal(100) # e.g. 1.0% -> 0.01
+        self._default_leverage = self.config.getint('BYBIT', 'default_leverage', fallback=10)
+        self._sl_pct_dec = Decimal(str(self.config.getfloat('BYBIT', 'stop_loss_percentage', fallback=0)))
+        self._tp_pct_dec = Decimal(str(self.config.getfloat('BYBIT', 'take_profit_percentage', fallback=0)))
+        self._tp_trigger_by = self.config.get('BYBIT', 'tp_trigger_by', fallback="LastPrice")
+        self._sl_trigger_by = self.config.get('BYBIT', 'sl_trigger_by', fallback="LastPrice")
+
     async def start(self):
         if self.running: logger.warning("TradingBot is already running."); return
-        self._shutdown_event.clear(); self.running = True; self.start_time = datetime.now()
+        self._reload_config()
+        self._shutdown_event.clear(); self.running = True; self.start_time = datetime.now(); self._start_monotonic = time.monotonic()
         if self.loop is None or self.loop.is_closed(): self.loop = asyncio.get_running_loop()
         logger.info("TradingBot starting sequence...")
 
-        if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-            self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar("Bot Starting...", "blue"))
-            self._app_instance.master.after(0, lambda: self._app_instance.update_license_info("Validating...", "-"))
+        self._ui_post('update_status_bar', "Bot Starting...", "blue")
+        self._ui_post('update_license_info', "Validating...", "-")
         if not await self._check_license(): 
             logger.critical("License invalid. Bot will not start."); self.running = False
-            if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists(): self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar("Bot Stopped: License Invalid", "red"))
+            self._ui_post('update_status_bar', "Bot Stopped: License Invalid", "red")
             return
         
         await self.update_initial_trading_data() 
         
         if not self.bybit_connected:
             logger.error("Bybit connection failed. Bot will not start."); self.running = False
-            if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists(): self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar("Bot Stopped: Bybit Connection Failed", "red"))
+            self._ui_post('update_status_bar', "Bot Stopped: Bybit Connection Failed", "red")
             return
         
         if self.telegram_bot:
             logger.info("TradingBot: Starting Telegram bot component..."); tg_task = self.loop.create_task(self.telegram_bot.run()); self._periodic_tasks.append(tg_task)
         else: logger.warning("TradingBot: TelegramBot not initialized.")
         
+        if self.enable_position_stream:
+            self._position_stream_active = await asyncio.to_thread(self.bybit_trader.start_position_stream, self._ws_position_handler)
+            if not self._position_stream_active: logger.warning("Position stream unavailable. Falling back to REST polling only.")
+        self._periodic_tasks.append(self.loop.create_task(self._closed_position_worker())) # Also drains closures queued by the initial reconcile
         self._periodic_tasks.append(self.loop.create_task(self._periodic_fetch_bybit_metrics()))
-        self._periodic_tasks.append(self.loop.create_task(self._periodic_update_runtime()))
+        self._last_runtime_str = None; self._schedule_runtime_tick(0)
         self._periodic_tasks.append(self.loop.create_task(self._periodic_verify_and_maintain_tpsl()))
+        self._periodic_tasks.append(self.loop.create_task(self._periodic_positions_flusher()))
         
-        if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists(): self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar("Bot Running", "green"))
+        self._ui_post('update_status_bar', "Bot Running", "green")
         logger.info("TradingBot main loop starting...")
         try:
-            while self.running and not self._shutdown_event.is_set(): await asyncio.sleep(1)
+            await self._shutdown_event.wait() # Set by stop() or by clearing running
         except asyncio.CancelledError: logger.info("TradingBot main loop cancelled.")
         except Exception as e: logger.error(f"TradingBot main loop error: {e}", exc_info=True)
         finally: 
             logger.info("TradingBot main loop finishing.")
-            await self._cleanup_tasks() 
-            self._save_active_positions_to_disk() 
-            self._save_trade_history_to_disk()   
+            stop_task = self._stop_task
+            if stop_task is not None and not stop_task.done():
+                # stop() woke us and is still shutting Telegram/Bybit down; returning now would let the caller close the loop under it
+                await asyncio.wait((stop_task,)) # Does not raise; stop() logs its own errors
+            else:
+                await self._cleanup_tasks() 
+                await self._flush_state_to_disk()
             self.running = False
             logger.info("TradingBot successfully set running=False in main loop finally.")
 
@@ -688,17 +893,46 @@ class TradingBot:
         except asyncio.CancelledError: logger.info("Periodic metrics task cancelled.")
         except Exception as e: logger.error(f"Error in periodic metrics fetch: {e}", exc_info=True)
 
-    async def _periodic_update_runtime(self):
+    async def _periodic_positions_flusher(self):
+        try:
+            while self.running and not self._shutdown_event.is_set():
+                await self._positions_dirty.wait()
+                await asyncio.sleep(POSITIONS_FLUSH_DEBOUNCE_SECONDS) # Coalesce a burst of updates into a single write
+                self._positions_dirty.clear()
+                self._save_active_positions_to_disk()
+        except asyncio.CancelledError: logger.info("Active positions flusher task cancelled.")
+        except Exception as e: logger.error(f"Error in active positions flusher task: {e}", exc_info=True)
+
+    def _schedule_runtime_tick(self, delay: float = RUNTIME_TICK_SECONDS):
+        self._runtime_handle = self.loop.call_later(delay, self._runtime_tick)
+
+    def _runtime_tick(self):
+        """Pushes the runtime string to the UI. Re-arms itself only while the window is visible; on_ui_mapped() restarts it."""
+        self._runtime_handle = None
+        if not (self.running and self.start_time) or self._shutdown_event.is_set():
+            return
         try:
-            while self.running and self.start_time and not self._shutdown_event.is_set():
-                if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists(): self._app_instance.master.after(0, lambda: self._app_instance.update_runtime_ui(self.get_runtime_str()))
-                await asyncio.sleep(1)
-        except asyncio.CancelledError: logger.info("Runtime update task cancelled.")
-        except Exception as e: logger.error(f"Error in runtime update task: {e}", exc_info=True)
+            if not self._ui_visible(): # Hidden or destroyed: stop ticking
+                return
+            runtime_str = self.get_runtime_str()
+            if runtime_str != self._last_runtime_str: # Only hop to the Tk thread when the displayed value changes
+                self._ui_post('update_runtime_ui', runtime_str)
+                self._last_runtime_str = runtime_str
+        except Exception as e: logger.error(f"Error in runtime update tick: {e}", exc_info=True)
+        self._schedule_runtime_tick()
 
     async def _verify_and_set_tpsl_for_position(self, symbol: str, intended_tp: Optional[Decimal], intended_sl: Optional[Decimal], position_idx: int) -> bool:
-        logger.info(f"Verifying TP/SL for {symbol} (PosIdx: {position_idx}). Intended TP: {intended_tp}, SL: {intended_sl}")
         pos_key = (symbol, position_idx)
+        last_applied = self._last_applied_tpsl.get(pos_key)
+        if last_applied and time.monotonic() - last_applied[2] < TPSL_RESYNC_TTL_SECONDS:
+            tracked_details = self.active_positions_details.get(pos_key)
+            intended_tp_now = tracked_details.intended_tp1 if tracked_details else None
+            intended_sl_now = tracked_details.intended_sl if tracked_details else None
+            if (last_applied[0], last_applied[1]) == (self._format_price_decimal(intended_tp_now, symbol) if intended_tp_now else None,
+                                                      self._format_price_decimal(intended_sl_now, symbol) if intended_sl_now else None):
+                logger.debug("TP/SL for %s (PosIdx: %s) unchanged since last confirmation. Skipping verification.", symbol, position_idx)
+                return True
+        logger.info("Verifying TP/SL for %s (PosIdx: %s). Intended TP: %s, SL: %s", symbol, position_idx, intended_tp, intended_sl)
         
         for attempt in range(TPSL_VERIFICATION_RETRIES + 1): 
             tracked_details = self.active_positions_details.get(pos_key)
@@ -707,46 +941,47 @@ class TradingBot:
                 return True 
 
             try:
-                current_positions_on_exchange = await self.bybit_trader.get_open_positions(symbol=symbol, settleCoin=self.bybit_trader.default_coin)
+                current_positions_on_exchange = await self.bybit_trader.get_open_positions(symbol=symbol, settleCoin=self._default_coin)
                 target_position_data = next((p for p in current_positions_on_exchange if p.get('symbol') == symbol and p.get('positionIdx') == position_idx), None)
                 
-                if not target_position_data or float(target_position_data.get('size', '0')) == 0:
-                    main_order_status = tracked_details.get('main_order_status')
-                    if main_order_status in ['New', 'Submitted', 'PartiallyFilled'] and not tracked_details.get('entry_price'):
+                if not target_position_data or not _size_positive(target_position_data.get('size')):
+                    main_order_status = tracked_details.main_order_status
+                    if main_order_status in ['New', 'Submitted', 'PartiallyFilled'] and not tracked_details.entry_price:
                         logger.info(f"Entry order for {symbol} (PosIdx: {position_idx}) is still '{main_order_status}' and no position formed. TP/SL verification skipped.")
                         return True 
                     else: 
                         logger.info(f"Position {symbol} (PosIdx: {position_idx}) no longer found or size is zero during TP/SL set. Handling as closed.")
                         # Check if still tracked before handling close, to avoid race condition if another task already handled it
                         if pos_key in self.active_positions_details:
-                            await self._handle_closed_position(pos_key, closed_position_data=tracked_details)
+                            self._enqueue_closed_position(pos_key)
                         return True 
 
                 current_tp_str = target_position_data.get('takeProfit')
                 current_sl_str = target_position_data.get('stopLoss')
-                logger.debug(f"{symbol} PosIdx {position_idx}: Current TP on exchange: '{current_tp_str}', SL: '{current_sl_str}'")
+                logger.debug("%s PosIdx %s: Current TP on exchange: '%s', SL: '%s'", symbol, position_idx, current_tp_str, current_sl_str)
 
-                current_tp_decimal = Decimal(current_tp_str) if current_tp_str and current_tp_str != "0" else None
-                current_sl_decimal = Decimal(current_sl_str) if current_sl_str and current_sl_str != "0" else None
+                current_tp_decimal = _dec(current_tp_str or "")
+                current_sl_decimal = _dec(current_sl_str or "")
 
-                effective_intended_tp = tracked_details.get('intended_tp1') 
-                effective_intended_sl = tracked_details.get('intended_sl')
+                effective_intended_tp = tracked_details.intended_tp1 
+                effective_intended_sl = tracked_details.intended_sl
 
-                formatted_intended_tp = Decimal(self._format_price(effective_intended_tp, symbol)) if effective_intended_tp else None
-                formatted_intended_sl = Decimal(self._format_price(effective_intended_sl, symbol)) if effective_intended_sl else None
+                formatted_intended_tp = self._format_price_decimal(effective_intended_tp, symbol) if effective_intended_tp else None
+                formatted_intended_sl = self._format_price_decimal(effective_intended_sl, symbol) if effective_intended_sl else None
                 
                 tp_matches = (formatted_intended_tp == current_tp_decimal) or (not formatted_intended_tp and not current_tp_decimal)
                 sl_matches = (formatted_intended_sl == current_sl_decimal) or (not formatted_intended_sl and not current_sl_decimal)
 
                 if tp_matches and sl_matches:
-                    logger.info(f"TP/SL for {symbol} (PosIdx: {position_idx}) are correctly set. Formatted Intended TP: {formatted_intended_tp}, SL: {formatted_intended_sl}.")
+                    logger.info("TP/SL for %s (PosIdx: %s) are correctly set. Formatted Intended TP: %s, SL: %s.", symbol, position_idx, formatted_intended_tp, formatted_intended_sl)
+                    self._last_applied_tpsl[pos_key] = (formatted_intended_tp, formatted_intended_sl, time.monotonic())
                     return True
 
                 logger.warning(f"TP/SL mismatch for {symbol} (PosIdx: {position_idx}). Attempt {attempt + 1}. "
                                f"Intended (Formatted) TP: {formatted_intended_tp}, SL: {formatted_intended_sl}. Exchange TP: {current_tp_decimal}, SL: {current_sl_decimal}. Attempting to set.")
                 
-                tp_to_set_str = self._format_price(effective_intended_tp, symbol) if effective_intended_tp else "0" 
-                sl_to_set_str = self._format_price(effective_intended_sl, symbol) if effective_intended_sl else "0" 
+                tp_to_set_str = str(formatted_intended_tp) if effective_intended_tp else "0" 
+                sl_to_set_str = str(formatted_intended_sl) if effective_intended_sl else "0" 
 
                 success = await self.bybit_trader.set_trading_stop(
                     symbol=symbol, take_profit=tp_to_set_str, stop_loss=sl_to_set_str,   
@@ -755,10 +990,12 @@ class TradingBot:
                 if success:
                     logger.info(f"Successfully re-applied TP/SL for {symbol} (PosIdx: {position_idx}) on attempt {attempt + 1}. TP: {tp_to_set_str}, SL: {sl_to_set_str}")
                     if pos_key in self.active_positions_details: 
-                        self.active_positions_details[pos_key]['intended_tp1'] = effective_intended_tp 
-                        self.active_positions_details[pos_key]['intended_sl'] = effective_intended_sl   
-                        self.active_positions_details[pos_key]['last_update_time'] = datetime.utcnow()
-                        self._save_active_positions_to_disk() 
+                        tracked_now = self.active_positions_details[pos_key]
+                        tracked_now.intended_tp1 = effective_intended_tp 
+                        tracked_now.intended_sl = effective_intended_sl   
+                        tracked_now.last_update_time = self._now_utc()
+                        self._mark_positions_dirty() 
+                        self._last_applied_tpsl[pos_key] = (formatted_intended_tp, formatted_intended_sl, time.monotonic())
                     await asyncio.sleep(1) 
                     return True 
                 else:
@@ -780,6 +1017,103 @@ class TradingBot:
                     return False
         return False 
 
+    async def _fetch_last_prices(self, symbols: Set[str]) -> Dict[str, str]:
+        """Fetches last prices in a single tickers call (whole category when more than one symbol is needed), keyed by symbol."""
+        if not self.bybit_trader or not hasattr(self.bybit_trader, 'get_tickers'):
+            return {}
+        single_symbol = next(iter(symbols)) if len(symbols) == 1 else None
+        tickers_data = await self.bybit_trader.get_tickers(category=self._trading_category, symbol=single_symbol)
+        if not tickers_data or not isinstance(tickers_data, list):
+            return {}
+        return {t.get('symbol'): t.get('lastPrice') for t in tickers_data if t.get('symbol') in symbols and t.get('lastPrice')}
+
+    async def _maintain_position_tpsl(self, pos_key: Tuple[str, int], pos_by_key: Dict[Tuple[str, int], Dict], last_prices: Dict[str, str]):
+        """Runs TP/SL and break-even maintenance for one tracked position. Bounded by _tpsl_sema."""
+        async with self._tpsl_sema:
+            if pos_key not in self.active_positions_details: 
+                logger.debug("Position %s no longer in active_positions_details. Skipping maintenance.", pos_key)
+                return 
+
+            symbol, position_idx = pos_key
+            pos_details = self.active_positions_details[pos_key] 
+        
+            main_order_status = pos_details.main_order_status
+            # Changed: Also allow 'N/A (External/Synced)' for externally managed positions that might need BE
+            if main_order_status not in self._ALLOW_MAINT_STATUSES: 
+                logger.debug("Main entry order for %s (PosIdx %s) is still '%s'. Skipping TP/SL maintenance for now.", symbol, position_idx, main_order_status)
+                return 
+
+            pos_data_from_api = pos_by_key.get(pos_key)
+
+            if not pos_data_from_api:
+                logger.info(f"Position {symbol} (PosIdx {position_idx}) no longer active on exchange (periodic check). Handling as closed.")
+                self._enqueue_closed_position(pos_key) 
+                return 
+
+            live_avg_price = _dec(pos_data_from_api.get('avgPrice') or "")
+            if live_avg_price:
+                if pos_details.entry_price != live_avg_price: 
+                    logger.info(f"Updating tracked entry price for {symbol} (PosIdx {position_idx}) from {pos_details.entry_price} to {live_avg_price}")
+                    pos_details.entry_price = live_avg_price
+                    self._mark_positions_dirty() 
+        
+            actual_entry_price = pos_details.entry_price or pos_details.signal_entry_price 
+            tp1_target_price_for_be = pos_details.tp1_price
+            breakeven_already_applied = pos_details.breakeven_applied
+            pos_side = pos_details.side # Stored uppercase at insertion
+            # --- ฟีเจอร์ใหม่: Partial TP แล้วย้าย SL ไป BE ---
+            if self.enable_breakeven_on_partial_tp and not breakeven_already_applied and actual_entry_price:
+                live_size = _dec(pos_data_from_api.get('size') or "") or Decimal(0)
+                last_known_size = pos_details.last_known_size
+                if last_known_size is not None and live_size < last_known_size:
+                    pos_details.intended_sl = actual_entry_price
+                    pos_details.breakeven_applied = True
+                    self._mark_positions_dirty()
+                    self._add_trade_to_history(symbol, "System", pos_side, str(live_size), str(actual_entry_price), None, "SL to Break-Even (Partial TP)", notes=f"PosIdx {position_idx}, Partial TP")
+                    ui_status_log(f"ขนาด position {symbol} ลดลง (TP บางส่วน) ย้าย SL ไป BE อัตโนมัติ")
+                    if self.telegram_bot and hasattr(self.telegram_bot, 'send_message_async'):
+                        await self.telegram_bot.send_message_async(f"ขนาด position {symbol} ลดลง (TP บางส่วน) ย้าย SL ไป BE อัตโนมัติ")
+                pos_details.last_known_size = live_size
+            # --- END ฟีเจอร์ใหม่ ---
+            # ... logic BE เดิม ...
+            if self.enable_breakeven_on_tp1 and not breakeven_already_applied and \
+               tp1_target_price_for_be and actual_entry_price and actual_entry_price > 0:
+                tp1_hit_condition_met = False
+                current_market_price = None
+                try:
+                    market_price_str = last_prices.get(symbol)
+                    if market_price_str:
+                        current_market_price = Decimal(market_price_str)
+                        logger.debug("BE Check for %s (PosIdx %s): Market Price=%s, TP1 Target=%s", symbol, position_idx, current_market_price, tp1_target_price_for_be)
+                    if current_market_price:
+                        if pos_side == 'BUY' and current_market_price >= tp1_target_price_for_be:
+                            tp1_hit_condition_met = True
+                            logger.info(f"BE Condition MET (BUY) for {symbol}: Market Price {current_market_price} >= TP1 {tp1_target_price_for_be}")
+                        elif pos_side == 'SELL' and current_market_price <= tp1_target_price_for_be:
+                            tp1_hit_condition_met = True
+                            logger.info(f"BE Condition MET (SELL) for {symbol}: Market Price {current_market_price} <= TP1 {tp1_target_price_for_be}")
+                    else:
+                        logger.warning(f"Could not get current market price for {symbol} to check break-even condition for PosIdx {position_idx}.")
+                    if tp1_hit_condition_met:
+                        new_sl_target_for_be = actual_entry_price 
+                        formatted_new_sl = self._format_price_decimal(new_sl_target_for_be, symbol) 
+                        current_formatted_intended_sl = self._format_price_decimal(pos_details.intended_sl, symbol) if pos_details.intended_sl else None
+                        if current_formatted_intended_sl != formatted_new_sl : 
+                            logger.info(f"TP1 condition met for {symbol} (PosIdx {position_idx}). Moving SL to Break-Even: {formatted_new_sl} (from actual entry: {actual_entry_price})")
+                            pos_details.intended_sl = new_sl_target_for_be 
+                            pos_details.breakeven_applied = True
+                            self._mark_positions_dirty() 
+                            self._add_trade_to_history(symbol, "System", pos_side, pos_data_from_api.get('size', 'N/A'), 
+                                                       str(actual_entry_price), None, "SL to Break-Even", 
+                                                       notes=f"PosIdx {position_idx}, TP1 hit")
+                        else:
+                            logger.info(f"Break-even SL for {symbol} (PosIdx {position_idx}) already at or effectively at entry price {formatted_new_sl}. No change needed, marking BE as applied.")
+                            pos_details.breakeven_applied = True 
+                            self._mark_positions_dirty() 
+                except Exception as e_be:
+                    logger.error(f"Error during Break-Even logic for {symbol} (PosIdx {position_idx}): {e_be}", exc_info=True)
+            await self._verify_and_set_tpsl_for_position(symbol, pos_details.intended_tp1, pos_details.intended_sl, position_idx)
+
     async def _periodic_verify_and_maintain_tpsl(self):
         logger.info("Starting periodic TP/SL verification and maintenance task.")
         await asyncio.sleep(15) 
@@ -794,98 +1128,32 @@ class TradingBot:
                     logger.debug("No positions currently tracked for TP/SL maintenance.")
                     await asyncio.sleep(TPSL_PERIODIC_CHECK_INTERVAL_SECONDS); continue
 
-                logger.debug(f"Periodic TP/SL Check: Processing {len(tracked_position_keys)} tracked positions.")
-                
-                for pos_key in tracked_position_keys:
-                    if pos_key not in self.active_positions_details: 
-                        logger.debug(f"Position {pos_key} no longer in active_positions_details. Skipping maintenance.")
-                        continue 
-
-                    symbol, position_idx = pos_key
-                    pos_details = self.active_positions_details[pos_key] 
-                    
-                    main_order_status = pos_details.get('main_order_status')
-                    # Changed: Also allow 'N/A (External/Synced)' for externally managed positions that might need BE
-                    if main_order_status not in ['Filled', 'N/A (External/Synced)']: 
-                        logger.debug(f"Main entry order for {symbol} (PosIdx {position_idx}) is still '{main_order_status}'. Skipping TP/SL maintenance for now.")
-                        continue 
-
-                    current_positions_on_exchange = await self.bybit_trader.get_open_positions(symbol=symbol, settleCoin=self.bybit_trader.default_coin)
-                    pos_data_from_api = next((p for p in current_positions_on_exchange if p.get('symbol') == symbol and p.get('positionIdx') == position_idx), None)
-
-                    if not pos_data_from_api or float(pos_data_from_api.get('size', '0')) == 0:
-                        logger.info(f"Position {symbol} (PosIdx {position_idx}) no longer active on exchange (periodic check). Handling as closed.")
-                        await self._handle_closed_position(pos_key, closed_position_data=pos_details) 
-                        continue 
-
-                    live_avg_price_str = pos_data_from_api.get('avgPrice')
-                    if live_avg_price_str and live_avg_price_str != "0":
-                        live_avg_price = Decimal(live_avg_price_str)
-                        if pos_details.get('entry_price') != live_avg_price: 
-                            logger.info(f"Updating tracked entry price for {symbol} (PosIdx {position_idx}) from {pos_details.get('entry_price')} to {live_avg_price}")
-                            pos_details['entry_price'] = live_avg_price
-                            self._save_active_positions_to_disk() 
-                    
-                    actual_entry_price = pos_details.get('entry_price') or pos_details.get('signal_entry_price') 
-                    tp1_target_price_for_be = pos_details.get('tp1_price')
-                    breakeven_already_applied = pos_details.get('breakeven_applied', False)
-                    pos_side = pos_details.get('side', '').upper()
-                    # --- ฟีเจอร์ใหม่: Partial TP แล้วย้าย SL ไป BE ---
-                    if self.enable_breakeven_on_partial_tp and not breakeven_already_applied and actual_entry_price:
-                        live_size = Decimal(pos_data_from_api.get('size', '0'))
-                        last_known_size = pos_details.get('last_known_size', live_size)
-                        if live_size < last_known_size:
-                            pos_details['intended_sl'] = actual_entry_price
-                            pos_details['breakeven_applied'] = True
-                            self._save_active_positions_to_disk()
-                            self._add_trade_to_history(symbol, "System", pos_side, str(live_size), str(actual_entry_price), None, "SL to Break-Even (Partial TP)", notes=f"PosIdx {position_idx}, Partial TP")
-                            ui_status_log(f"ขนาด position {symbol} ลดลง (TP บางส่วน) ย้าย SL ไป BE อัตโนมัติ")
-                            if self.telegram_bot and hasattr(self.telegram_bot, 'send_message_async'):
-                                await self.telegram_bot.send_message_async(f"ขนาด position {symbol} ลดลง (TP บางส่วน) ย้าย SL ไป BE อัตโนมัติ")
-                        pos_details['last_known_size'] = live_size
-                    # --- END ฟีเจอร์ใหม่ ---
-                    # ... logic BE เดิม ...
-                    if self.enable_breakeven_on_tp1 and not breakeven_already_applied and \
-                       tp1_target_price_for_be and actual_entry_price and actual_entry_price > 0:
-                        tp1_hit_condition_met = False
-                        current_market_price = None
-                        try:
-                            if self.bybit_trader and hasattr(self.bybit_trader, 'get_tickers'):
-                                tickers_data = await self.bybit_trader.get_tickers(category=self.bybit_trader.trading_category, symbol=symbol)
-                                if tickers_data and isinstance(tickers_data, list) and len(tickers_data) > 0:
-                                    market_price_str = tickers_data[0].get('lastPrice')
-                                    if market_price_str:
-                                        current_market_price = Decimal(market_price_str)
-                                        logger.debug(f"BE Check for {symbol} (PosIdx {position_idx}): Market Price={current_market_price}, TP1 Target={tp1_target_price_for_be}")
-                            if current_market_price:
-                                if pos_side == 'BUY' and current_market_price >= tp1_target_price_for_be:
-                                    tp1_hit_condition_met = True
-                                    logger.info(f"BE Condition MET (BUY) for {symbol}: Market Price {current_market_price} >= TP1 {tp1_target_price_for_be}")
-                                elif pos_side == 'SELL' and current_market_price <= tp1_target_price_for_be:
-                                    tp1_hit_condition_met = True
-                                    logger.info(f"BE Condition MET (SELL) for {symbol}: Market Price {current_market_price} <= TP1 {tp1_target_price_for_be}")
-                            else:
-                                logger.warning(f"Could not get current market price for {symbol} to check break-even condition for PosIdx {position_idx}.")
-                            if tp1_hit_condition_met:
-                                new_sl_target_for_be = actual_entry_price 
-                                formatted_new_sl = Decimal(self._format_price(new_sl_target_for_be, symbol)) 
-                                current_formatted_intended_sl = Decimal(self._format_price(pos_details.get('intended_sl'), symbol)) if pos_details.get('intended_sl') else None
-                                if current_formatted_intended_sl != formatted_new_sl : 
-                                    logger.info(f"TP1 condition met for {symbol} (PosIdx {position_idx}). Moving SL to Break-Even: {formatted_new_sl} (from actual entry: {actual_entry_price})")
-                                    pos_details['intended_sl'] = new_sl_target_for_be 
-                                    pos_details['breakeven_applied'] = True
-                                    self._save_active_positions_to_disk() 
-                                    self._add_trade_to_history(symbol, "System", pos_side, pos_data_from_api.get('size', 'N/A'), 
-                                                               str(actual_entry_price), None, "SL to Break-Even", 
-                                                               notes=f"PosIdx {position_idx}, TP1 hit")
-                                else:
-                                    logger.info(f"Break-even SL for {symbol} (PosIdx {position_idx}) already at or effectively at entry price {formatted_new_sl}. No change needed, marking BE as applied.")
-                                    pos_details['breakeven_applied'] = True 
-                                    self._save_active_positions_to_disk() 
-                        except Exception as e_be:
-                            logger.error(f"Error during Break-Even logic for {symbol} (PosIdx {position_idx}): {e_be}", exc_info=True)
-                    await self._verify_and_set_tpsl_for_position(symbol, pos_details.get('intended_tp1'), pos_details.get('intended_sl'), position_idx)
-                    await asyncio.sleep(0.2) 
+                logger.debug("Periodic TP/SL Check: Processing %d tracked positions.", len(tracked_position_keys))
+
+                # One bulk fetch per cycle instead of one positions/tickers round-trip per tracked position
+                if self._position_stream_active:
+                    pos_by_key = dict(self._api_pos_index) # Kept current by the position stream; REST reconcile remains the fallback
+                    if any(key not in pos_by_key for key in tracked_position_keys):
+                        # A push may still be pending (fresh fill, reconnect gap): REST decides before anything is closed
+                        rest_positions = await self.bybit_trader.get_open_positions(settleCoin=self._default_coin, use_cache=False, none_on_error=True)
+                        if rest_positions is None: # Unconfirmed: skip this cycle rather than close positions on a failed fetch
+                            await self._wait_for_position_update(TPSL_PERIODIC_CHECK_INTERVAL_SECONDS); continue
+                        rest_by_key = self._index_positions(rest_positions)
+                        for key in tracked_position_keys:
+                            if key not in pos_by_key and key in rest_by_key:
+                                pos_by_key[key] = self._api_pos_index[key] = rest_by_key[key]
+                else:
+                    all_positions_on_exchange = await self.bybit_trader.get_open_positions(settleCoin=self._default_coin)
+                    pos_by_key = self._index_positions(all_positions_on_exchange)
+                be_check_symbols = {sym for (sym, _), details in self.active_positions_details.items()
+                                    if self.enable_breakeven_on_tp1 and not details.breakeven_applied and details.tp1_price}
+                last_prices = await self._fetch_last_prices(be_check_symbols) if be_check_symbols else {}
+
+                results = await asyncio.gather(*(self._maintain_position_tpsl(pos_key, pos_by_key, last_prices) for pos_key in tracked_position_keys),
+                                               return_exceptions=True)
+                for pos_key, res in zip(tracked_position_keys, results):
+                    if isinstance(res, Exception):
+                        logger.error(f"Error maintaining TP/SL for {pos_key}: {res}", exc_info=res)
 
             except asyncio.CancelledError:
                 logger.info("Periodic TP/SL verification task cancelled.")
@@ -893,68 +1161,138 @@ class TradingBot:
             except Exception as e:
                 logger.error(f"Error in periodic TP/SL verification task: {e}", exc_info=True)
             
-            await asyncio.sleep(TPSL_PERIODIC_CHECK_INTERVAL_SECONDS) 
+            await self._wait_for_position_update(TPSL_PERIODIC_CHECK_INTERVAL_SECONDS) 
         logger.info("Periodic TP/SL verification and maintenance task stopped.")
 
+    async def _wait_until_flat(self, symbol: str, timeout: float) -> bool:
+        """Polls the exchange (bypassing the positions cache) until symbol has no open position or timeout elapses.
+        Only a successful empty response counts as flat; failed fetches keep polling."""
+        deadline = time.monotonic() + timeout
+        while True:
+            positions = await self.bybit_trader.get_open_positions(symbol=symbol, use_cache=False, none_on_error=True)
+            if positions is not None and not positions:
+                return True
+            if time.monotonic() >= deadline:
+                logger.warning(f"{symbol} not confirmed flat {timeout}s after closing (positions open or fetch failing); continuing with entry.")
+                return False
+            await asyncio.sleep(PRE_ENTRY_FLAT_POLL_SECONDS)
+
+    async def _wait_for_position_update(self, timeout: float):
+        """Sleeps up to timeout, returning early (but no sooner than POSITION_STREAM_MIN_CYCLE_SECONDS) on a position stream push."""
+        if not self._position_stream_active:
+            await asyncio.sleep(timeout); return
+        await asyncio.sleep(POSITION_STREAM_MIN_CYCLE_SECONDS)
+        try: await asyncio.wait_for(self._positions_updated.wait(), timeout - POSITION_STREAM_MIN_CYCLE_SECONDS)
+        except asyncio.TimeoutError: pass
+        self._positions_updated.clear()
+
+    def _ws_position_handler(self, message: Dict):
+        """pybit callback (websocket thread): hands position pushes to the event loop."""
+        updates = message.get('data') or []
+        if updates and self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._apply_position_updates, updates)
+
+    def _apply_position_updates(self, updates: List[Dict]):
+        """Merges pushed positions into _api_pos_index and current_open_positions (runs on the event loop)."""
+        material = False
+        for p in updates:
+            if not p.get('symbol'):
+                continue
+            if 'avgPrice' not in p and p.get('entryPrice'):
+                p['avgPrice'] = p['entryPrice'] # Stream reports entryPrice; REST reports avgPrice
+            pos_key = (p['symbol'], p.get('positionIdx', 0))
+            prev = self._api_pos_index.get(pos_key)
+            if self._is_active_position(p):
+                self._api_pos_index[pos_key] = p
+                if prev is None or any(prev.get(f) != p.get(f) for f in ('size', 'side', 'avgPrice')):
+                    material = True
+            elif self._api_pos_index.pop(pos_key, None) is not None:
+                material = True
+        self.current_open_positions = list(self._api_pos_index.values())
+        self.total_positions_count = len(self._api_pos_index)
+        if material: # Mark/PnL-only pushes arrive constantly; they wait for the normal interval
+            self._positions_updated.set()
+
 
     async def _cleanup_tasks(self):
-        logger.info(f"Cleaning up {len(self._periodic_tasks)} tasks...")
-        for task in self._periodic_tasks:
-            if task and not task.done(): 
+        tasks = [t for t in self._periodic_tasks if t] # Snapshot and clear up front; the list must not change under the gather
+        names = [t.get_name() for t in tasks]
+        self._periodic_tasks.clear()
+        logger.info(f"Cleaning up {len(tasks)} tasks...")
+        if self._runtime_handle:
+            self._runtime_handle.cancel(); self._runtime_handle = None
+        for task in tasks:
+            if not task.done(): 
                 task.cancel()
-        if self._periodic_tasks: 
-            results = await asyncio.gather(*self._periodic_tasks, return_exceptions=True)
-            for i, res in enumerate(results):
+        if tasks: 
+            try:
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+            finally:
+                # If we are cancelled while waiting, gather cancels its children but does not wait for them;
+                # make sure none is left running detached.
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+            for task_name, res in zip(names, results):
                 if isinstance(res, Exception) and not isinstance(res, asyncio.CancelledError):
-                    task_name = "Unknown Task"
-                    if i < len(self._periodic_tasks) and hasattr(self._periodic_tasks[i], 'get_name'):
-                        task_name = self._periodic_tasks[i].get_name()
-                    logger.error(f"Error cleaning task {task_name} (index {i}): {res}")
-        self._periodic_tasks.clear()
+                    logger.error(f"Error cleaning task {task_name}: {res}")
+        if self._closed_inflight and not self._closed_inflight.done(): # Closure the worker was in the middle of
+            await self._closed_inflight # Never raises: _process_closed_item logs its own errors
+        self._closed_inflight = None
+        while not self._closed_queue.empty(): # Finish closures the worker did not get to
+            await self._process_closed_item(self._closed_queue.get_nowait())
         logger.info("Tasks cleanup complete.")
 
     async def stop(self):
         logger.info("TradingBot stopping sequence...");
         if not self.running: logger.info("TradingBot was not running."); return
+        self._stop_task = asyncio.current_task()
         
         self.running = False 
         self._shutdown_event.set() 
         
-        if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists(): 
-            self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar("Bot Stopping...", "orange"))
+        self._ui_post('update_status_bar', "Bot Stopping...", "orange")
         
         await self._cleanup_tasks() 
         
+        shutdowns = {} # Independent I/O shutdowns; run them concurrently
         if self.telegram_bot and hasattr(self.telegram_bot, 'stop'):
-            logger.info("Stopping TelegramBot...");
-            try: await self.telegram_bot.stop()
-            except Exception as e_tg_stop: logger.error(f"Error stopping TelegramBot: {e_tg_stop}", exc_info=True)
-        self.telegram_connected = False
-        
+            logger.info("Stopping TelegramBot..."); shutdowns["TelegramBot"] = self.telegram_bot.stop()
         if self.bybit_trader and hasattr(self.bybit_trader, 'close'): 
-            logger.info("Closing BybitTrader (if applicable)...");
-            try: await self.bybit_trader.close() 
-            except Exception as e_bybit_close: logger.error(f"Error closing BybitTrader: {e_bybit_close}", exc_info=True)
+            logger.info("Closing BybitTrader (if applicable)..."); shutdowns["BybitTrader"] = self.bybit_trader.close()
+        if shutdowns:
+            results = await asyncio.gather(*shutdowns.values(), return_exceptions=True)
+            for name, res in zip(shutdowns, results):
+                if isinstance(res, Exception): logger.error(f"Error shutting down {name}: {res}", exc_info=res)
+        self.telegram_connected = False
         self.bybit_connected = False
         
-        self._save_active_positions_to_disk()
-        self._save_trade_history_to_disk()
+        await self._flush_state_to_disk()
         logger.info("Final state saved to disk.")
 
         self.current_balance=self.current_available_balance=self.current_margin=0.0; self.total_orders_count=self.total_positions_count=0
-        if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-            self._app_instance.master.after(0, self._app_instance.update_trading_info_ui) 
-            self._app_instance.master.after(0, lambda: self._app_instance.update_bybit_status_ui(False))
-            self._app_instance.master.after(0, lambda: self._app_instance.update_telegram_status_ui(False))
-            self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar("Bot Stopped", "gray"))
+        self._available_balance_dec = Decimal(0)
+        self._ui_post(self._apply_stopped_ui) # One Tk event for the whole stopped-state refresh
 
         logger.info("TradingBot stopped successfully.")
 
 
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    @running.setter
+    def running(self, value: bool):
+        self._running = value
+        if not value and self.loop and not self.loop.is_closed():
+            # Callers on other threads (e.g. the UI) may clear the flag directly; wake start() which waits on the event.
+            self.loop.call_soon_threadsafe(self._shutdown_event.set)
+
     def get_runtime_str(self) -> str:
-        if not self.running or self.start_time is None: return "00:00:00"
-        s = int((datetime.now() - self.start_time).total_seconds())
-        return f"{s//3600:02}:{(s%3600)//60:02}:{s%60:02}"
+        if not self.running or self._start_monotonic is None: return "00:00:00"
+        s = int(time.monotonic() - self._start_monotonic)
+        h, rem = divmod(s, 3600); m, sec = divmod(rem, 60)
+        return f"{h:02}:{m:02}:{sec:02}"
 
     async def _calculate_position_size_fixed(self, signal: TradingSignal) -> Decimal:
         await self._fetch_and_store_instrument_info(signal.symbol)
@@ -964,53 +1302,54 @@ class TradingBot:
                                            fallback=self.config.get('BYBIT', 'max_position_size', fallback='0.001'))
         try:
             order_qty_asset = Decimal(order_qty_asset_str)
-            logger.info(f"Fixed position size for {signal.symbol}: {order_qty_asset} (from config: '{max_size_config_key}' or 'max_position_size')")
+            logger.info("Fixed position size for %s: %s (from config: '%s' or 'max_position_size')", signal.symbol, order_qty_asset, max_size_config_key)
             return order_qty_asset
         except InvalidOperation:
             logger.error(f"Invalid fixed position size in config for {signal.symbol}: '{order_qty_asset_str}'. Defaulting to 0.")
-            return Decimal('0')
+            return _DEC_ZERO
 
     async def _calculate_position_size_risk_percentage(self, signal: TradingSignal) -> Decimal:
         await self._fetch_and_store_instrument_info(signal.symbol)
 
         if self.current_available_balance <= 0: 
             logger.error(f"Available balance is {self.current_available_balance:.2f}. Cannot calculate risk-based position size for {signal.symbol}.")
-            return Decimal('0')
+            return _DEC_ZERO
 
-        if not signal.entry_price or signal.entry_price <= Decimal(0):
+        if not signal.entry_price or signal.entry_price <= _DEC_ZERO:
             logger.error(f"Valid entry price required for risk-based position size calculation for {signal.symbol}. Signal entry: {signal.entry_price}")
-            return Decimal('0')
+            return _DEC_ZERO
         
-        if not signal.stop_loss or signal.stop_loss <= Decimal(0):
+        if not signal.stop_loss or signal.stop_loss <= _DEC_ZERO:
             logger.error(f"Valid stop loss required for risk-based position size calculation for {signal.symbol}. Signal SL: {signal.stop_loss}")
-            return Decimal('0')
+            return _DEC_ZERO
 
         entry_price = signal.entry_price
         stop_loss_price = signal.stop_loss
 
         if signal.position.upper() == "LONG" and entry_price <= stop_loss_price:
             logger.error(f"Invalid LONG signal for risk calculation: Entry {entry_price} <= SL {stop_loss_price}")
-            return Decimal('0')
+            return _DEC_ZERO
         if signal.position.upper() == "SHORT" and entry_price >= stop_loss_price:
             logger.error(f"Invalid SHORT signal for risk calculation: Entry {entry_price} >= SL {stop_loss_price}")
-            return Decimal('0')
+            return _DEC_ZERO
 
         price_diff_per_unit = abs(entry_price - stop_loss_price)
-        if price_diff_per_unit <= Decimal(0):
+        if price_diff_per_unit <= _DEC_ZERO:
             logger.error(f"Price difference for risk calculation is zero or negative for {signal.symbol}. Entry: {entry_price}, SL: {stop_loss_price}")
-            return Decimal('0')
+            return _DEC_ZERO
 
-        risk_amount_usdt = Decimal(str(self.current_available_balance)) * (Decimal(str(self.risk_per_trade_percentage)) / Decimal('100'))
+        risk_amount_usdt = self._available_balance_dec * self._risk_frac_dec
         position_size_asset = risk_amount_usdt / price_diff_per_unit
         
-        logger.info(f"Risk-based calculation for {signal.symbol}: AvailBal={self.current_available_balance:.2f}, Risk%={self.risk_per_trade_percentage}, "
-                    f"RiskAmt={risk_amount_usdt:.2f}, Entry={entry_price}, SL={stop_loss_price}, PriceDiff={price_diff_per_unit}, CalcQty={position_size_asset:.8f}")
+        logger.info("Risk-based calculation for %s: AvailBal=%.2f, Risk%%=%s, RiskAmt=%.2f, Entry=%s, SL=%s, PriceDiff=%s, CalcQty=%.8f",
+                    signal.symbol, self.current_available_balance, self.risk_per_trade_percentage,
+                    risk_amount_usdt, entry_price, stop_loss_price, price_diff_per_unit, position_size_asset)
         return position_size_asset
 
 
     async def _determine_total_entry_qty(self, signal: TradingSignal) -> Decimal:
-        logger.debug(f"Determining entry quantity for {signal.symbol} using mode: {self.position_size_mode}")
-        calculated_qty_asset = Decimal('0')
+        logger.debug("Determining entry quantity for %s using mode: %s", signal.symbol, self.position_size_mode)
+        calculated_qty_asset = _DEC_ZERO
 
         if self.position_size_mode == 'fixed':
             calculated_qty_asset = await self._calculate_position_size_fixed(signal)
@@ -1020,9 +1359,9 @@ class TradingBot:
             logger.warning(f"Unknown position_size_mode: '{self.position_size_mode}'. Defaulting to fixed calculation.")
             calculated_qty_asset = await self._calculate_position_size_fixed(signal)
         
-        if calculated_qty_asset <= Decimal(0):
+        if calculated_qty_asset <= _DEC_ZERO:
             logger.error(f"Calculated quantity for {signal.symbol} is zero or negative ({calculated_qty_asset}). Cannot proceed.")
-            return Decimal('0')
+            return _DEC_ZERO
 
         min_order_qty_str = self._get_instrument_detail(signal.symbol, 'minOrderQty', str(DEFAULT_MIN_ORDER_QTY))
         try:
@@ -1038,7 +1377,7 @@ class TradingBot:
                 qty=str(calculated_qty_asset), price=str(signal.entry_price) if signal.entry_price else "Market",
                 order_id="N/A", status="Fail: Qty < Min"
             )
-            return Decimal('0')
+            return _DEC_ZERO
             
         return calculated_qty_asset
 
@@ -1046,8 +1385,7 @@ class TradingBot:
     async def execute_trade_from_signal(self, signal: TradingSignal):
         if not self.running or not self.bybit_connected:
             logger.warning("Bot/Bybit not ready for trade execution based on signal.")
-            if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-                self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar("Trade: Bot not ready.", "red"))
+            self._ui_post('update_status_bar', "Trade: Bot not ready.", "red")
             return False
 
         if signal.symbol.upper() != self.target_trading_symbol:
@@ -1060,67 +1398,66 @@ class TradingBot:
 
         # --- ปิด position เดิมก่อนเข้าไม้ใหม่ ---
         open_positions = await self.bybit_trader.get_open_positions(symbol=signal.symbol)
-        for pos in open_positions:
-            size = float(pos.get('size', 0))
-            if size > 0:
-                side = pos.get('side')
-                pos_idx = pos.get('positionIdx', 0)
-                await self.bybit_trader.close_position(symbol=signal.symbol, side_of_position_to_close=side, qty_to_close=size, position_idx=pos_idx)
+        to_close = [(pos.get('side'), float(pos.get('size', 0)), pos.get('positionIdx', 0)) for pos in open_positions if float(pos.get('size', 0)) > 0]
+        if to_close:
+            results = await asyncio.gather(*(
+                self.bybit_trader.close_position(symbol=signal.symbol, side_of_position_to_close=side, qty_to_close=size, position_idx=pos_idx)
+                for side, size, pos_idx in to_close), return_exceptions=True)
+            for (side, size, pos_idx), res in zip(to_close, results):
+                if isinstance(res, Exception):
+                    logger.error(f"Failed to close existing {signal.symbol} {side} (Idx: {pos_idx}) before entry: {res}")
+                    continue
                 ui_status_log(f"ปิด position เดิม {signal.symbol} ขนาด {size} ฝั่ง {side} ก่อนเข้าไม้ใหม่")
                 if self.telegram_bot and hasattr(self.telegram_bot, 'send_message_async'):
                     await self.telegram_bot.send_message_async(f"ปิด position เดิม {signal.symbol} ขนาด {size} ฝั่ง {side} ก่อนเข้าไม้ใหม่")
-                await asyncio.sleep(1)  # รอให้ปิด position สำเร็จ
+            await self._wait_until_flat(signal.symbol, PRE_ENTRY_FLAT_TIMEOUT_SECONDS) # รอให้ปิด position สำเร็จ
         # --- END ปิด position เดิม ---
 
+        total_entry_qty_decimal = await self._determine_total_entry_qty(signal) # Also loads instrument info for the symbol
+
         # --- LOG BLOCK แบบในรูป ---
         order_msg = (
             f"🚩 กำลังเข้าออเดอร์: {signal.symbol}\n"
             f"รายละเอียดสัญญาณ:\n"
             f"- คู่เงิน: {signal.symbol}\n"
             f"- ทิศทาง: {signal.position}\n"
-            f"- เลเวอเรจ: {signal.leverage if signal.leverage else self.config.getint('BYBIT', 'default_leverage', fallback=10)}\n"
-            f"- จำนวน: {str(await self._determine_total_entry_qty(signal))}\n"
+            f"- เลเวอเรจ: {signal.leverage if signal.leverage else self._default_leverage}\n"
+            f"- จำนวน: {total_entry_qty_decimal}\n"
             f"- จำนวน TP: {len(signal.take_profits)}\n"
             f"- ราคาเปิด: {signal.entry_price if signal.entry_price else 'Market'}\n"
             f"- Stop Loss: {signal.stop_loss if signal.stop_loss else '-'}\n"
         )
-        if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-            self._app_instance.master.after(0, lambda: ui_status_log(order_msg))
+        processing_text = f"Trade: Processing {signal.position} {signal.symbol}..."
+        if self._ui_alive():
+            self._ui_post(self._apply_signal_entry_ui, order_msg, processing_text) # Log + status bar in one Tk event
         else:
             ui_status_log(order_msg)
         # --- END LOG BLOCK ---
 
-        if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-            self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar(f"Trade: Processing {signal.position} {signal.symbol}...", "orange"))
-
-        await self._fetch_and_store_instrument_info(signal.symbol) 
-
         try:
-            total_entry_qty_decimal = await self._determine_total_entry_qty(signal)
-            if total_entry_qty_decimal <= Decimal(0):
+            if total_entry_qty_decimal <= _DEC_ZERO:
                 logger.error(f"Total entry quantity determined to be zero or negative for {signal.symbol}. Aborting trade.")
                 return False
 
             total_entry_qty_str = self._format_quantity(total_entry_qty_decimal, signal.symbol)
-            if Decimal(total_entry_qty_str) <= Decimal(0): 
+            if Decimal(total_entry_qty_str) <= _DEC_ZERO: 
                 logger.error(f"Formatted entry quantity '{total_entry_qty_str}' is zero or negative for {signal.symbol}. Aborting trade.")
                 self._add_trade_to_history(
                      symbol=signal.symbol, order_type="System", side=signal.position,
                      qty=total_entry_qty_str, price=str(signal.entry_price) if signal.entry_price else "Market",
                      order_id="N/A", status="Fail: Qty Format Error"
                 )
-                if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-                    self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar(f"Trade: Qty Format Error for {signal.symbol}", "red"))
+                self._ui_post('update_status_bar', f"Trade: Qty Format Error for {signal.symbol}", "red")
                 return False
             logger.info(f"Formatted total entry quantity for {signal.symbol}: {total_entry_qty_str} (Decimal: {total_entry_qty_decimal})")
 
             position_idx_for_trade = 0 
             
             existing_pos_details = self.active_positions_details.get((signal.symbol, position_idx_for_trade))
-            if existing_pos_details and existing_pos_details.get('side','').upper() != signal.position.upper():
-                logger.warning(f"Signal for {signal.symbol} ({signal.position}) is opposite to existing tracked position ({existing_pos_details.get('side')}). Manual check advised. Proceeding with new signal.")
+            if existing_pos_details and existing_pos_details.side != signal.position.upper():
+                logger.warning(f"Signal for {signal.symbol} ({signal.position}) is opposite to existing tracked position ({existing_pos_details.side}). Manual check advised. Proceeding with new signal.")
 
-            leverage_to_set = str(signal.leverage if signal.leverage else self.config.getint('BYBIT', 'default_leverage', fallback=10))
+            leverage_to_set = str(signal.leverage if signal.leverage else self._default_leverage)
             leverage_set_successfully = await self.bybit_trader.set_leverage(signal.symbol, leverage_to_set, leverage_to_set) 
 
             if not leverage_set_successfully:
@@ -1130,20 +1467,19 @@ class TradingBot:
                     qty=total_entry_qty_str, price=str(signal.entry_price) if signal.entry_price else "Market",
                     order_id="N/A", status="Fail: Leverage Set"
                 )
-                if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-                    self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar(f"Trade: Leverage Set Fail {signal.symbol}", "red"))
+                self._ui_post('update_status_bar', f"Trade: Leverage Set Fail {signal.symbol}", "red")
                 return False
             logger.info(f"Leverage for {signal.symbol} confirmed/set to x{leverage_to_set}.")
 
             entry_order_side = "Buy" if signal.position.upper() == "LONG" else "Sell"
-            entry_order_type = "Limit" if signal.entry_price and signal.entry_price > Decimal(0) else "Market"
+            entry_order_type = "Limit" if signal.entry_price and signal.entry_price > _DEC_ZERO else "Market"
             entry_price_for_order_str = self._format_price(signal.entry_price, signal.symbol) if entry_order_type == "Limit" and signal.entry_price else None
 
             intended_sl_price = signal.stop_loss
-            intended_tp1_price = next((tp for tp in signal.take_profits if tp and tp > Decimal(0)), None)
+            intended_tp1_price = signal.first_positive_tp
 
             entry_price_for_calc = signal.entry_price 
-            if not entry_price_for_calc or entry_price_for_calc <= Decimal(0): 
+            if not entry_price_for_calc or entry_price_for_calc <= _DEC_ZERO: 
                 logger.info(f"Signal for {signal.symbol} is Market or has no entry price. Fetching current price for TP/SL calculation.")
                 tickers_data = await self.bybit_trader.get_tickers(category=self.bybit_trader.trading_category, symbol=signal.symbol)
                 if tickers_data and isinstance(tickers_data, list) and len(tickers_data) > 0:
@@ -1153,27 +1489,27 @@ class TradingBot:
                 else:
                     logger.warning(f"Could not fetch current market price for {signal.symbol} market order. TP/SL from % might be inaccurate or skipped.")
             
-            if entry_price_for_calc and entry_price_for_calc > Decimal(0):
+            if entry_price_for_calc and entry_price_for_calc > _DEC_ZERO:
                 if not intended_sl_price: 
-                    sl_percentage_config = self.config.getfloat('BYBIT', 'stop_loss_percentage', fallback=0)
-                    if sl_percentage_config > 0:
-                        if signal.position.upper() == "LONG": intended_sl_price = entry_price_for_calc * (Decimal(1) - (Decimal(str(sl_percentage_config)) / Decimal(100)))
-                        else: intended_sl_price = entry_price_for_calc * (Decimal(1) + (Decimal(str(sl_percentage_config)) / Decimal(100)))
+                    sl_percentage_config = self._sl_pct_dec
+                    if sl_percentage_config > _DEC_ZERO:
+                        if signal.position.upper() == "LONG": intended_sl_price = entry_price_for_calc * (_DEC_1 - (sl_percentage_config / _DEC_100))
+                        else: intended_sl_price = entry_price_for_calc * (_DEC_1 + (sl_percentage_config / _DEC_100))
                         logger.info(f"Calculated SL for {signal.symbol} based on {sl_percentage_config}%: {intended_sl_price} (from entry {entry_price_for_calc})")
                 
                 if not intended_tp1_price: 
-                    tp_percentage_config = self.config.getfloat('BYBIT', 'take_profit_percentage', fallback=0)
-                    if tp_percentage_config > 0:
-                        if signal.position.upper() == "LONG": intended_tp1_price = entry_price_for_calc * (Decimal(1) + (Decimal(str(tp_percentage_config)) / Decimal(100)))
-                        else: intended_tp1_price = entry_price_for_calc * (Decimal(1) - (Decimal(str(tp_percentage_config)) / Decimal(100)))
+                    tp_percentage_config = self._tp_pct_dec
+                    if tp_percentage_config > _DEC_ZERO:
+                        if signal.position.upper() == "LONG": intended_tp1_price = entry_price_for_calc * (_DEC_1 + (tp_percentage_config / _DEC_100))
+                        else: intended_tp1_price = entry_price_for_calc * (_DEC_1 - (tp_percentage_config / _DEC_100))
                         logger.info(f"Calculated TP1 for {signal.symbol} based on {tp_percentage_config}%: {intended_tp1_price} (from entry {entry_price_for_calc})")
 
-            sl_price_for_main_order_str = self._format_price(intended_sl_price, signal.symbol) if intended_sl_price and intended_sl_price > Decimal(0) else None
-            first_tp_price_for_main_order_str = self._format_price(intended_tp1_price, signal.symbol) if intended_tp1_price and intended_tp1_price > Decimal(0) else None
+            sl_price_for_main_order_str = self._format_price(intended_sl_price, signal.symbol) if intended_sl_price and intended_sl_price > _DEC_ZERO else None
+            first_tp_price_for_main_order_str = self._format_price(intended_tp1_price, signal.symbol) if intended_tp1_price and intended_tp1_price > _DEC_ZERO else None
             
-            logger.info(f"Placing main entry order for {signal.symbol} (PosIdx {position_idx_for_trade}): {entry_order_side} {total_entry_qty_str} "
-                        f"@ {entry_price_for_order_str or 'Market'}, "
-                        f"Attempting TP: {first_tp_price_for_main_order_str or 'N/A'}, SL: {sl_price_for_main_order_str or 'N/A'}")
+            logger.info("Placing main entry order for %s (PosIdx %s): %s %s @ %s, Attempting TP: %s, SL: %s",
+                        signal.symbol, position_idx_for_trade, entry_order_side, total_entry_qty_str, entry_price_for_order_str or 'Market',
+                        first_tp_price_for_main_order_str or 'N/A', sl_price_for_main_order_str or 'N/A')
 
             entry_order_result = await self.bybit_trader.place_order(
                 symbol=signal.symbol, side=entry_order_side, qty=total_entry_qty_str,
@@ -1183,8 +1519,8 @@ class TradingBot:
                 stop_loss=float(sl_price_for_main_order_str) if sl_price_for_main_order_str else None,
                 position_idx=position_idx_for_trade, 
                 tpsl_mode="Partial", 
-                tp_trigger_by=self.config.get('BYBIT', 'tp_trigger_by', fallback="LastPrice"),
-                sl_trigger_by=self.config.get('BYBIT', 'sl_trigger_by', fallback="LastPrice")
+                tp_trigger_by=self._tp_trigger_by,
+                sl_trigger_by=self._sl_trigger_by
             )
 
             if not entry_order_result or entry_order_result.get('retCode') != 0 or not entry_order_result.get('result', {}).get('orderId'):
@@ -1195,12 +1531,11 @@ class TradingBot:
                     qty=total_entry_qty_str, price=entry_price_for_order_str or "Market",
                     order_id="N/A", status=f"Fail: Entry - {error_msg}"
                 )
-                if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-                    self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar(f"Trade: Entry Fail {signal.symbol} ({error_msg})", "red"))
+                self._ui_post('update_status_bar', f"Trade: Entry Fail {signal.symbol} ({error_msg})", "red")
                 return False
             
             main_order_id = entry_order_result['result']['orderId']
-            entry_price_for_tracking = entry_price_for_calc if entry_price_for_calc and entry_price_for_calc > Decimal(0) else None 
+            entry_price_for_tracking = entry_price_for_calc if entry_price_for_calc and entry_price_for_calc > _DEC_ZERO else None 
 
             self._add_trade_to_history(
                 symbol=signal.symbol, order_type=entry_order_type, side=entry_order_side,
@@ -1209,28 +1544,25 @@ class TradingBot:
                 notes=f"PosIdx {position_idx_for_trade}, Initial TP@{first_tp_price_for_main_order_str or 'N/A'}, SL@{sl_price_for_main_order_str or 'N/A'}"
             )
             logger.info(f"Main entry order for {signal.symbol} (PosIdx {position_idx_for_trade}) placed. ID: {main_order_id}")
-            if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-                 self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar(f"Trade: {signal.symbol} Entry Placed", "green"))
+            self._ui_post('update_status_bar', f"Trade: {signal.symbol} Entry Placed", "green")
 
             current_pos_key = (signal.symbol, position_idx_for_trade)
-            self.active_positions_details[current_pos_key] = {
-                'symbol': signal.symbol,
-                'position_idx': position_idx_for_trade,
-                'side': signal.position.upper(),
-                'entry_price': None, 
-                'signal_entry_price': entry_price_for_tracking, 
-                'intended_sl': intended_sl_price, 
-                'intended_tp1': intended_tp1_price, 
-                'tp1_price': intended_tp1_price, 
-                'breakeven_applied': False,
-                'main_order_id': main_order_id,
-                'main_order_status': 'New', 
-                'tp_order_ids': [], 
-                'last_update_time': datetime.utcnow(),
-                'last_known_size': total_entry_qty_decimal 
-            }
-            logger.info(f"Stored initial details for {signal.symbol} (PosIdx {position_idx_for_trade}): TP1={intended_tp1_price}, SL={intended_sl_price}, SignalEntry={entry_price_for_tracking}")
-            self._save_active_positions_to_disk() 
+            self.active_positions_details[current_pos_key] = TrackedPosition(
+                symbol=signal.symbol,
+                position_idx=position_idx_for_trade,
+                side=signal.position.upper(),
+                signal_entry_price=entry_price_for_tracking, 
+                intended_sl=intended_sl_price, 
+                intended_tp1=intended_tp1_price, 
+                tp1_price=intended_tp1_price, 
+                main_order_id=main_order_id,
+                main_order_status='New', 
+                last_update_time=self._now_utc(),
+                last_known_size=total_entry_qty_decimal 
+            )
+            logger.info("Stored initial details for %s (PosIdx %s): TP1=%s, SL=%s, SignalEntry=%s",
+                        signal.symbol, position_idx_for_trade, intended_tp1_price, intended_sl_price, entry_price_for_tracking)
+            self._mark_positions_dirty() 
 
             if entry_order_type == "Market" or (first_tp_price_for_main_order_str or sl_price_for_main_order_str):
                 await asyncio.sleep(TPSL_VERIFICATION_DELAY_SECONDS) 
@@ -1245,8 +1577,7 @@ class TradingBot:
                 symbol=signal.symbol, order_type="System", side=signal.position,
                 qty="N/A", price="N/A", order_id="N/A", status=f"ERROR: {str(e)[:30]}"
             )
-            if self._app_instance and hasattr(self._app_instance, 'master') and self._app_instance.master.winfo_exists():
-                 self._app_instance.master.after(0, lambda: self._app_instance.update_status_bar(f"Trade Error: {str(e)[:50]}", "red"))
+            self._ui_post('update_status_bar', f"Trade Error: {str(e)[:50]}", "red")
             return False
 
     def get_active_positions_display_data(self) -> List[Dict[str, Any]]:
@@ -1255,19 +1586,18 @@ class TradingBot:
 
         for key, details in active_details_copy:
             symbol, pos_idx = key
-            current_pos_on_exchange = next((p for p in self.current_open_positions 
-                                            if p.get('symbol') == symbol and p.get('positionIdx') == pos_idx), None)
+            current_pos_on_exchange = self._api_pos_index.get(key) # Same (symbol, positionIdx) index reconcile uses
             
-            size_display = details.get('last_known_size', 'N/A') 
+            size_display = details.last_known_size 
             if size_display is not None and not isinstance(size_display, str): size_display = str(size_display)
             
-            entry_price_display = str(details.get('entry_price', 'N/A')) 
+            entry_price_display = str(details.entry_price) 
             unrealised_pnl_display = '0.00' 
 
             if current_pos_on_exchange: 
-                size_display = current_pos_on_exchange.get('size', str(details.get('last_known_size', 'N/A')))
-                if float(current_pos_on_exchange.get('size','0')) > 0:
-                    entry_price_display = current_pos_on_exchange.get('avgPrice', str(details.get('entry_price', 'N/A')))
+                size_display = current_pos_on_exchange.get('size', str(details.last_known_size))
+                if _size_positive(current_pos_on_exchange.get('size')):
+                    entry_price_display = current_pos_on_exchange.get('avgPrice', str(details.entry_price))
                 
                 pnl_val_str = current_pos_on_exchange.get('unrealisedPnl', '0')
                 try: 
@@ -1277,14 +1607,14 @@ class TradingBot:
             
             data_item = {
                 "symbol_pidx": f"{symbol} ({pos_idx})",
-                "side_size": f"{details.get('side', 'N/A')} | {size_display}",
+                "side_size": f"{details.side or 'N/A'} | {size_display}",
                 "entry": entry_price_display,
                 "pnl": unrealised_pnl_display,
-                "sl": str(details.get('intended_sl', 'N/A')),
-                "tp1": str(details.get('intended_tp1', 'N/A')),
-                "be_applied": "Yes" if details.get('breakeven_applied') else "No",
-                "main_order_status": str(details.get('main_order_status', 'N/A')),
-                "tp_orders_left": str(len(details.get('tp_order_ids', []))), 
+                "sl": str(details.intended_sl),
+                "tp1": str(details.intended_tp1),
+                "be_applied": "Yes" if details.breakeven_applied else "No",
+                "main_order_status": str(details.main_order_status),
+                "tp_orders_left": str(len(details.tp_order_ids)), 
             }
             display_data.append(data_item)
         return display_data
@@ -1,20 +1,29 @@
-import httpx
+import functools
+import hashlib
 import json
 import logging
 import logging.handlers
 import os
-from typing import Any, Dict, Optional, Tuple # Added Tuple
-from configparser import ConfigParser, NoSectionError, NoOptionError # Added specific exceptions
-from cryptography.fernet import Fernet
+import re
+from typing import Any, Dict, List, Optional, Tuple # Added Tuple
+from configparser import DuplicateSectionError, NoSectionError, NoOptionError # Added specific exceptions
 from dotenv import load_dotenv
-from tenacity import retry, stop_after_attempt, wait_exponential, RetryError # Added RetryError
 import time
+import array
 import asyncio
 import inspect
-from pybit.unified_trading import HTTP
-
-# Load environment variables from .env file
-load_dotenv()
+import queue
+import threading
+from pathlib import Path
+try:
+    import orjson # Optional; much faster serialization of state files
+except ImportError:
+    orjson = None
+
+# Load environment variables from .env file (once per process, even if this module is reloaded)
+if not globals().get('_DOTENV_LOADED'):
+    load_dotenv()
+    _DOTENV_LOADED = True
 
 # Configure basic logging (can be overridden by main app's logger setup)
 # This initial setup is useful if utils.py is imported before main logger is configured.
@@ -29,86 +38,261 @@ if not logging.getLogger().hasHandlers(): # Check if root logger already has han
 
 logger = logging.getLogger(__name__) # Get a logger specific to this module
 
+_SECTION_RE = re.compile(r"^\[([^\]]+)\]\s*$")
+_KV_RE = re.compile(r"^([^=:\s][^=:]*?)\s*[=:]\s*(.*?)\s*$")
+_UNSET = object()
+_MISSING = object() # Cached marker for an option that is not in the config
+
+class FastConfigParser:
+    """Minimal ConfigParser replacement for flat `[section]` / `key = value` INI files.
+    No interpolation, DEFAULT section or multi-line values; option names are lower-cased like ConfigParser does."""
+    _TRUE = frozenset({'1', 'yes', 'true', 'on'}) # Same spellings ConfigParser.BOOLEAN_STATES accepts
+    _FALSE = frozenset({'0', 'no', 'false', 'off'})
+
+    def __init__(self):
+        self._data: Dict[str, Dict[str, str]] = {}
+
+    def read_string(self, text: str, source: str = '<string>'):
+        data = self._data
+        section = None
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            m = _SECTION_RE.match(line)
+            if m:
+                section = data.setdefault(m.group(1).strip(), {})
+                continue
+            m = _KV_RE.match(line)
+            if m and section is not None:
+                section[m.group(1).lower()] = m.group(2)
+            else:
+                logger.warning(f"FastConfigParser: ignoring unparsable line in {source}: {line!r}")
+
+    def read(self, path: str, encoding: Optional[str] = None):
+        self.read_string(Path(path).read_text(encoding=encoding or 'utf-8'), source=path)
+
+    def read_dict(self, mapping: Dict[str, Dict[str, Any]]):
+        for section, options in mapping.items():
+            target = self._data.setdefault(section, {})
+            for key, value in options.items():
+                target[key.lower()] = str(value)
+
+    def to_dict(self) -> Dict[str, Dict[str, str]]:
+        return {section: dict(options) for section, options in self._data.items()}
+
+    def sections(self) -> List[str]:
+        return list(self._data)
+
+    def has_section(self, section: str) -> bool:
+        return section in self._data
+
+    def add_section(self, section: str):
+        if section in self._data:
+            raise DuplicateSectionError(section)
+        self._data[section] = {}
+
+    def has_option(self, section: str, option: str) -> bool:
+        return option.lower() in self._data.get(section, ())
+
+    def __getitem__(self, section: str) -> Dict[str, str]:
+        return self._data[section]
+
+    def get(self, section: str, option: str, fallback: Any = _UNSET) -> Any:
+        try:
+            options = self._data[section]
+        except KeyError:
+            if fallback is _UNSET: raise NoSectionError(section)
+            return fallback
+        try:
+            return options[option.lower()]
+        except KeyError:
+            if fallback is _UNSET: raise NoOptionError(option, section)
+            return fallback
+
+    def _get_conv(self, section: str, option: str, conv, fallback: Any) -> Any:
+        try:
+            value = self._data[section][option.lower()]
+        except KeyError:
+            if fallback is _UNSET:
+                self.get(section, option) # Raises NoSectionError / NoOptionError
+            return fallback
+        return conv(value)
+
+    def getint(self, section: str, option: str, fallback: Any = _UNSET) -> Any:
+        return self._get_conv(section, option, int, fallback)
+
+    def getfloat(self, section: str, option: str, fallback: Any = _UNSET) -> Any:
+        return self._get_conv(section, option, float, fallback)
+
+    def getboolean(self, section: str, option: str, fallback: Any = _UNSET) -> Any:
+        return self._get_conv(section, option, self.to_boolean, fallback)
+
+    @classmethod
+    def to_boolean(cls, value: str) -> bool:
+        v = value.strip().lower()
+        if v in cls._TRUE:
+            return True
+        if v in cls._FALSE:
+            return False
+        raise ValueError(f"Not a boolean: {value}")
+
+    def set(self, section: str, option: str, value: str):
+        try:
+            self._data[section][option.lower()] = value
+        except KeyError:
+            raise NoSectionError(section)
+
+    def write(self, fp, space_around_delimiters: bool = True):
+        delimiter = " = " if space_around_delimiters else "="
+        for section, options in self._data.items():
+            fp.write(f"[{section}]\n")
+            for key, value in options.items():
+                fp.write(f"{key}{delimiter}{value}\n")
+            fp.write("\n")
+
+_SENSITIVE_KEYS = frozenset({ # (section, option) pairs stored encrypted; Telegram api_id is numeric, not secret
+    ('BYBIT', 'api_key'), ('BYBIT', 'api_secret'),
+    ('Telegram', 'api_hash'), ('Telegram', 'phone'),
+    ('LICENSE', 'key'),
+})
+_FERNET_PREFIX = b'gAAAA' # Every Fernet token starts with this (version byte 0x80 + timestamp high bytes)
+
+@functools.lru_cache(maxsize=1)
+def _load_encryption_key() -> Optional[bytes]:
+    """Get encryption key from environment or create a new one. Memoized: one key per process."""
+    try:
+        key_str = os.getenv('CONFIG_ENCRYPTION_KEY')
+        if key_str:
+            return key_str.encode()
+        
+        logger.info("CONFIG_ENCRYPTION_KEY not found in .env, generating a new one.")
+        from cryptography.fernet import Fernet # Deferred: only needed when a key must be generated
+        key = Fernet.generate_key()
+        # Try to append to .env, handle potential errors
+        try:
+            with open('.env', 'a') as f: # 'a' to append
+                f.write(f'\nCONFIG_ENCRYPTION_KEY={key.decode()}\n')
+            logger.info("New CONFIG_ENCRYPTION_KEY appended to .env file.")
+            return key
+        except IOError as e:
+            logger.error(f"Could not write new encryption key to .env file: {e}. Encryption will be disabled.")
+            return None
+    except Exception as e:
+        logger.error(f"Error getting or creating encryption key: {e}", exc_info=True)
+        return None
+
 class SecureConfig:
     def __init__(self, config_path: str):
         self.config_path = config_path
-        self._config = ConfigParser(interpolation=None) # Use interpolation=None for raw values
-        self._key = self._get_or_create_key()
+        self._config = FastConfigParser() # Raw values, no interpolation
+        self._get_cache: Dict[Tuple[str, str, str], Any] = {} # (section, option, kind) -> converted value or _MISSING
+        self._raw_text_hash: Optional[bytes] = None # blake2b of the file text last parsed from config_path
+        self._key = _load_encryption_key()
         if self._key: # Only create Fernet if key is available
+            from cryptography.fernet import Fernet # Deferred so importing utils does not load cryptography
             self._fernet = Fernet(self._key)
         else:
             self._fernet = None # No encryption/decryption if key is missing
             logger.warning("Encryption key not found or generated. Sensitive config values will not be encrypted/decrypted.")
         self._load_config()
 
-    def _get_or_create_key(self) -> Optional[bytes]:
-        """Get encryption key from environment or create a new one."""
-        try:
-            key_str = os.getenv('CONFIG_ENCRYPTION_KEY')
-            if key_str:
-                return key_str.encode()
-            
-            logger.info("CONFIG_ENCRYPTION_KEY not found in .env, generating a new one.")
-            key = Fernet.generate_key()
-            # Try to append to .env, handle potential errors
-            try:
-                with open('.env', 'a') as f: # 'a' to append
-                    f.write(f'\nCONFIG_ENCRYPTION_KEY={key.decode()}\n')
-                logger.info("New CONFIG_ENCRYPTION_KEY appended to .env file.")
-                return key
-            except IOError as e:
-                logger.error(f"Could not write new encryption key to .env file: {e}. Encryption will be disabled.")
-                return None
-        except Exception as e:
-            logger.error(f"Error getting or creating encryption key: {e}", exc_info=True)
-            return None
-
-
     def _load_config(self):
         """Load and decrypt configuration."""
-        if not os.path.exists(self.config_path):
+        try:
+            st = os.stat(self.config_path)
+        except FileNotFoundError:
             logger.error(f"Config file not found: {self.config_path}")
             raise FileNotFoundError(f"Config file not found: {self.config_path}")
         
-        try:
-            # *** KEY CHANGE: Specify encoding as UTF-8 ***
-            self._config.read(self.config_path, encoding='utf-8')
-            logger.info(f"Successfully read config file: {self.config_path} with UTF-8 encoding.")
-        except Exception as e:
-            logger.error(f"Failed to read config file {self.config_path} with UTF-8: {e}", exc_info=True)
-            # Fallback or re-raise depending on desired behavior
-            raise
+        cache_header = (st.st_mtime_ns, st.st_size) # Taken before reading, so a concurrent edit only causes a miss
+        cached = self._read_config_cache(cache_header)
+        if cached is not None:
+            self._raw_text_hash, data = cached
+            self._config.read_dict(data)
+            logger.info(f"Loaded config {self.config_path} from parse cache.")
+        else:
+            try:
+                # *** KEY CHANGE: Specify encoding as UTF-8 ***
+                text, self._raw_text_hash = self._read_config_text(self.config_path, 'utf-8')
+                self._config.read_string(text, source=self.config_path)
+                logger.info(f"Successfully read config file: {self.config_path} with UTF-8 encoding.")
+            except Exception as e:
+                logger.error(f"Failed to read config file {self.config_path} with UTF-8: {e}", exc_info=True)
+                # Fallback or re-raise depending on desired behavior
+                raise
+            self._write_config_cache(cache_header) # Before decryption: only values as stored in the file are cached
             
         if self._fernet: # Only decrypt if fernet is initialized
             self._decrypt_sensitive_values()
         else:
             logger.warning("Fernet not initialized, skipping decryption of config values.")
+        self._get_cache.clear()
+
+
+    @staticmethod
+    def _read_config_text(path: str, encoding: str) -> Tuple[str, bytes]:
+        """Reads path with a single open/read and returns (text, blake2b digest of the text)."""
+        text = Path(path).read_text(encoding=encoding)
+        return text, hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    @property
+    def _cache_path(self) -> str:
+        return self.config_path + ".cache"
+
+    def _read_config_cache(self, header: Tuple[int, int]) -> Optional[Tuple[Optional[bytes], Dict[str, Dict[str, str]]]]:
+        """Returns (text hash, sections) cached for the config file if it was made from a file with the same mtime and size."""
+        try:
+            with open(self._cache_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f) # JSON, not pickle: loading the cache must never run code
+            cached_header, text_hash, data = tuple(cached['header']), cached['hash'], cached['sections']
+            if not isinstance(data, dict):
+                raise ValueError("sections is not an object")
+            text_hash = bytes.fromhex(text_hash) if text_hash is not None else None
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.debug(f"Ignoring unreadable config cache {self._cache_path}: {e}")
+            return None
+        return (text_hash, data) if cached_header == header else None
 
+    def _write_config_cache(self, header: Tuple[int, int]):
+        tmp_path = self._cache_path + ".tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'header': list(header),
+                           'hash': self._raw_text_hash.hex() if self._raw_text_hash is not None else None,
+                           'sections': self._config.to_dict()}, f)
+            os.chmod(tmp_path, 0o600) # O_CREAT mode is ignored for an existing file
+            os.replace(tmp_path, self._cache_path)
+        except OSError as e:
+            logger.debug(f"Could not write config cache {self._cache_path}: {e}")
+
+    def _invalidate_config_cache(self):
+        try:
+            os.remove(self._cache_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove config cache {self._cache_path}: {e}")
 
     def _decrypt_sensitive_values(self):
         """Decrypt sensitive configuration values if fernet is available."""
         if not self._fernet: return
 
-        sensitive_keys_map = {
-            'BYBIT': ['api_key', 'api_secret'],
-            'Telegram': ['api_hash', 'phone'], # api_id is usually numeric, not secret
-            'LICENSE': ['key']
-        }
         logger.debug("Attempting to decrypt sensitive config values...")
-        for section in self._config.sections():
-            if section in sensitive_keys_map:
-                for key in self._config[section]:
-                    if key in sensitive_keys_map[section]:
-                        value = self._config[section][key]
-                        # Check if value looks like a Fernet token (starts with 'gAAAA')
-                        if value and isinstance(value, str) and value.startswith('gAAAA'):
-                            try:
-                                decrypted_value = self._fernet.decrypt(value.encode()).decode()
-                                self._config[section][key] = decrypted_value
-                                logger.debug(f"Decrypted [{section}].{key}")
-                            except Exception as e:
-                                logger.error(f"Failed to decrypt [{section}].{key}: {e}. Value might not be encrypted or key is incorrect.")
-                        # else: logger.debug(f"Value for [{section}].{key} does not look encrypted, skipping decryption.")
+        from cryptography.fernet import InvalidToken
+        for section, key, raw in self._sensitive_values(self._config):
+            if raw[:5] != _FERNET_PREFIX: # Plaintext value; nothing to decrypt
+                continue
+            try:
+                decrypted_value = self._fernet.decrypt(raw)
+            except InvalidToken:
+                logger.error(f"Failed to decrypt [{section}].{key}: invalid token. Value might not be encrypted or key is incorrect.")
+                continue
+            self._config[section][key] = decrypted_value.decode()
+            logger.debug("Decrypted [%s].%s", section, key)
         logger.info("Sensitive value decryption process completed (if applicable).")
 
 
@@ -118,51 +302,40 @@ class SecureConfig:
             logger.warning("Fernet not initialized, cannot encrypt values for saving.")
             return
 
-        sensitive_keys_map = {
-            'BYBIT': ['api_key', 'api_secret'],
-            'Telegram': ['api_hash', 'phone'],
-            'LICENSE': ['key']
-        }
         logger.debug("Attempting to encrypt sensitive config values for saving...")
-        for section in self._config.sections():
-            if section in sensitive_keys_map:
-                for key in self._config[section]:
-                    if key in sensitive_keys_map[section]:
-                        value_to_encrypt = self._config[section][key]
-                        # Only encrypt if it's not already looking like an encrypted token
-                        if value_to_encrypt and not value_to_encrypt.startswith('gAAAA'):
-                            try:
-                                encrypted_value = self._fernet.encrypt(value_to_encrypt.encode()).decode()
-                                self._config[section][key] = encrypted_value # Temporarily set for writing
-                                logger.debug(f"Encrypted [{section}].{key} for saving.")
-                            except Exception as e:
-                                logger.error(f"Failed to encrypt [{section}].{key} for saving: {e}")
+        self._encrypt_in(self._config)
+        self._get_cache.clear()
         logger.info("Sensitive value encryption process for saving completed (if applicable).")
 
+    @staticmethod
+    def _sensitive_values(config: FastConfigParser) -> List[Tuple[str, str, bytes]]:
+        """(section, key, value as UTF-8 bytes) for every non-empty sensitive option present in config.
+        Encoded once here, since both the Fernet sniff and the cipher work on bytes."""
+        return [(section, key, value.encode()) for section, key in _SENSITIVE_KEYS
+                if (value := config.get(section, key, fallback=None))]
+
+    def _encrypt_in(self, config: FastConfigParser):
+        """Encrypts every sensitive value in config that is not already a Fernet token."""
+        pending = [(section, key, raw) for section, key, raw in self._sensitive_values(config)
+                   if raw[:5] != _FERNET_PREFIX]
+        try:
+            encrypted = [self._fernet.encrypt(raw) for _, _, raw in pending] # All or nothing, as before
+        except Exception as e:
+            logger.error(f"Failed to encrypt sensitive values for saving: {e}")
+            return
+        for (section, key, _), encrypted_value in zip(pending, encrypted):
+            config[section][key] = encrypted_value.decode()
+            logger.debug("Encrypted [%s].%s for saving.", section, key)
+
 
     def save(self):
         """Save configuration. Encrypts sensitive values before writing, then decrypts them back for runtime use."""
-        temp_config_to_save = ConfigParser(interpolation=None)
-        temp_config_to_save.read_dict(self._config) # Create a copy to encrypt for saving
+        self._invalidate_config_cache()
+        temp_config_to_save = FastConfigParser()
+        temp_config_to_save.read_dict(self._config.to_dict()) # Create a copy to encrypt for saving
 
         if self._fernet:
-            # Encrypt sensitive values in the temporary copy
-            sensitive_keys_map = {
-                'BYBIT': ['api_key', 'api_secret'],
-                'Telegram': ['api_hash', 'phone'],
-                'LICENSE': ['key']
-            }
-            for section in temp_config_to_save.sections():
-                if section in sensitive_keys_map:
-                    for key in temp_config_to_save[section]:
-                        if key in sensitive_keys_map[section]:
-                            value_to_encrypt = temp_config_to_save[section][key]
-                            if value_to_encrypt and not value_to_encrypt.startswith('gAAAA'):
-                                try:
-                                    encrypted_value = self._fernet.encrypt(value_to_encrypt.encode()).decode()
-                                    temp_config_to_save[section][key] = encrypted_value
-                                except Exception as e:
-                                    logger.error(f"Failed to encrypt [{section}].{key} during save: {e}")
+            self._encrypt_in(temp_config_to_save) # Encrypt sensitive values in the temporary copy
         else:
             logger.warning("Fernet not initialized, saving config values in plaintext.")
 
@@ -176,46 +349,52 @@ class SecureConfig:
         # No need to re-decrypt self._config as it was never changed if fernet was active.
         # If fernet was not active, values were already plaintext.
 
-    def get(self, section: str, option: str, fallback: Any = None) -> Any:
-        try:
-            return self._config.get(section, option, fallback=fallback)
-        except (NoSectionError, NoOptionError):
-            # logger.warning(f"Config: [{section}]/[{option}] not found, returning fallback '{fallback}'.")
-            return fallback
-
-    def getint(self, section: str, option: str, fallback: Optional[int] = None) -> Optional[int]:
-        try:
-            return self._config.getint(section, option, fallback=fallback)
-        except (NoSectionError, NoOptionError, ValueError):
-            # logger.warning(f"Config: [{section}]/[{option}] not found or not int, returning fallback '{fallback}'.")
-            return fallback
-            
-    def getfloat(self, section: str, option: str, fallback: Optional[float] = None) -> Optional[float]:
-        try:
-            return self._config.getfloat(section, option, fallback=fallback)
-        except (NoSectionError, NoOptionError, ValueError):
-            # logger.warning(f"Config: [{section}]/[{option}] not found or not float, returning fallback '{fallback}'.")
-            return fallback
-
-    def getboolean(self, section: str, option: str, fallback: Optional[bool] = None) -> Optional[bool]:
-        try:
-            return self._config.getboolean(section, option, fallback=fallback)
-        except (NoSectionError, NoOptionError, ValueError):
-            # logger.warning(f"Config: [{section}]/[{option}] not found or not bool, returning fallback '{fallback}'.")
-            return fallback
+    def _typed_get(self, section: str, option: str, fallback: Any = None, *, conv, kind: str) -> Any:
+        """Shared body of get/getint/getfloat/getboolean: a direct lookup in the parsed sections, converted with conv
+        and memoized until the config changes. Misses are cached too, but the caller's fallback is applied per call;
+        unconvertible values are not cached."""
+        key = (section, option, kind)
+        value = self._get_cache.get(key, _UNSET)
+        if value is _UNSET:
+            try:
+                raw = self._config[section][option.lower()]
+            except KeyError:
+                value = _MISSING
+            else:
+                try:
+                    value = conv(raw)
+                except ValueError:
+                    # logger.warning(f"Config: [{section}]/[{option}] is not a valid {kind}, returning fallback '{fallback}'.")
+                    return fallback
+            self._get_cache[key] = value
+        return fallback if value is _MISSING else value
+
+    get = functools.partialmethod(_typed_get, conv=str, kind='str')
+    getint = functools.partialmethod(_typed_get, conv=int, kind='int')
+    getfloat = functools.partialmethod(_typed_get, conv=float, kind='float')
+    getboolean = functools.partialmethod(_typed_get, conv=FastConfigParser.to_boolean, kind='bool')
 
     def set(self, section: str, option: str, value: Any):
         if not self._config.has_section(section):
             self._config.add_section(section)
         self._config.set(section, option, str(value))
+        self._get_cache.clear()
+        self._raw_text_hash = None # In-memory values now differ from the file; a later read() must re-parse
 
     def has_section(self, section: str) -> bool:
         return self._config.has_section(section)
 
     def read(self, path: str, encoding: Optional[str] = None): # Added for compatibility if main.py calls it
         logger.warning("SecureConfig.read() called. Config is usually loaded at initialization. Re-loading...")
-        self._config.read(path, encoding=encoding or 'utf-8')
+        text, text_hash = self._read_config_text(path, encoding or 'utf-8')
+        if path == self.config_path:
+            if text_hash == self._raw_text_hash:
+                logger.info(f"{path} unchanged since last load; keeping current values.")
+                return
+            self._raw_text_hash = text_hash
+        self._config.read_string(text, source=path)
         if self._fernet: self._decrypt_sensitive_values()
+        self._get_cache.clear()
 
     def write(self, fp, space_around_delimiters=True): # Added for compatibility
         logger.warning("SecureConfig.write() called. Use .save() for encryption-aware saving.")
@@ -224,98 +403,226 @@ class SecureConfig:
 
 
 # --- API Call Utilities ---
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
+_BYBIT_RETCODES = { # Bybit V5 retCode -> category; unknown codes fall back to _ERR_PATTERNS on the message
+    110007: 'balance', # Insufficient available balance
+    110001: 'order_gone', # Order does not exist
+    110008: 'order_gone', # Order has been completed or cancelled
+}
+_ERR_PATTERNS = ( # (lower-case retMsg substring, category) checked in order against the lower-cased message
+    ('insufficient available balance', 'balance'),
+    ('ordernotexist', 'order_gone'),
+    ('order has been filled or cancelled', 'order_gone'),
+)
+
+_IS_ASYNC: Dict[Any, bool] = {} # Underlying function -> whether calling it returns a coroutine
+
+def _is_async_callable(func) -> bool:
+    """Classifies func once. Bound methods are keyed by their __func__, since a new bound-method object is created on every attribute access."""
+    key = getattr(func, '__func__', func)
+    is_async = _IS_ASYNC.get(key)
+    if is_async is None:
+        is_async = inspect.iscoroutinefunction(func) or inspect.iscoroutinefunction(getattr(func, '__call__', None))
+        _IS_ASYNC[key] = is_async
+    return is_async
+
+API_CALL_ATTEMPTS = 3
+_httpx = None # httpx module, imported on the first API call
+
+def _lazy_httpx():
+    global _httpx
+    if _httpx is None:
+        import httpx
+        _httpx = httpx
+    return _httpx
+
+async def _call_with_retry(func, args, kwargs) -> Any:
+    """Performs the raw call, retrying only httpx.RequestError (network/connection) with 2s, 2s, 4s, ... backoff capped at 10s.
+    Any other exception, and the last RequestError, propagate immediately."""
+    httpx = _lazy_httpx()
+    for attempt in range(API_CALL_ATTEMPTS):
+        try:
+            if _is_async_callable(func):
+                return await func(*args, **kwargs)
+            response = func(*args, **kwargs)
+            if inspect.isawaitable(response): # Sync wrapper handing back a coroutine/Future
+                response = await response
+            return response
+        except httpx.RequestError as e:
+            if attempt == API_CALL_ATTEMPTS - 1:
+                raise
+            # Expected transient failure: no traceback
+            logger.warning("Request Error (Network/Connection) during API call %s (attempt %d/%d): %s",
+                           func.__name__, attempt + 1, API_CALL_ATTEMPTS, e)
+            await asyncio.sleep(min(10, max(2, 2 ** attempt))) # Same waits as the former wait_exponential(min=2, max=10)
+
 async def safe_api_call(func, *args, **kwargs) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
     """
     Safely calls an API function, handling common errors and retries.
     Returns (result_data, error_data).
     error_data will contain {'code': ..., 'msg': ...} if an API or HTTP error occurs.
     """
+    httpx = _lazy_httpx()
     try:
         # Ensure rate limit is handled before the call if applicable
         # if 'bybit_rate_limiter' in globals() and func.__module__.startswith('pybit'): # Example check
         #     await bybit_rate_limiter.acquire()
         
-        response = func(*args, **kwargs)
-        if inspect.isawaitable(response):
-            response = await response
+        response = await _call_with_retry(func, args, kwargs) # Only the network call is retried
         
         # Standard Bybit API v5 response structure check
         if isinstance(response, dict):
             ret_code = response.get('retCode')
             ret_msg = response.get('retMsg', 'Unknown error')
             
-            if ret_code is not None and ret_code == 0:
-                logger.debug(f"API call {func.__name__} successful. Result keys: {list(response.get('result', {}).keys()) if response.get('result') else 'No result field'}")
+            if ret_code == 0:
+                logger.debug("API call %s successful. has_result=%s", func.__name__, bool(response.get('result')))
                 return response, None # Success
             else:
                 # Log more specific Bybit errors if possible
-                if 'insufficient available balance' in ret_msg.lower():
+                tag = _BYBIT_RETCODES.get(ret_code)
+                if tag is None:
+                    lowered = ret_msg.lower()
+                    tag = next((t for pattern, t in _ERR_PATTERNS if pattern in lowered), None)
+                if tag == 'balance':
                     logger.error(f"Bybit API Error (Insufficient Balance) for {func.__name__}: {ret_code} - {ret_msg}. Args: {args}, Kwargs: {kwargs}")
-                elif 'ordernotexist' in ret_msg.lower() or 'order has been filled or cancelled' in ret_msg.lower():
+                elif tag == 'order_gone':
                     logger.warning(f"Bybit API Info (Order Not Found/Filled/Cancelled) for {func.__name__}: {ret_code} - {ret_msg}")
                 else:
                     logger.error(f"Bybit API Error for {func.__name__}: {ret_code} - {ret_msg}. Args: {args}, Kwargs: {kwargs}. Full Response: {response}")
                 return None, {'code': ret_code, 'msg': ret_msg, 'response': response} # Include full response in error for context
         
         # If response is not a dict or doesn't match Bybit structure, treat as success but log it
-        logger.debug(f"API call {func.__name__} returned non-standard response (or not a Bybit API call): {type(response)}. Assuming success.")
+        logger.debug("API call %s returned non-standard response (or not a Bybit API call): %s. Assuming success.", func.__name__, type(response))
         return response, None
 
     except httpx.HTTPStatusError as e: # Specific to httpx if used by func
-        logger.error(f"HTTP Status Error during API call {func.__name__}: {e.response.status_code} - {e.response.text}", exc_info=True)
+        logger.error("HTTP Status Error during API call %s: %s - %s", func.__name__, e.response.status_code, e.response.text,
+                     exc_info=logger.isEnabledFor(logging.DEBUG)) # The status line is enough outside debug
         return None, {'code': e.response.status_code, 'msg': e.response.text}
-    except httpx.RequestError as e: # Specific to httpx
-        logger.error(f"Request Error (Network/Connection) during API call {func.__name__}: {e}", exc_info=True)
-        # This is a candidate for retry by tenacity
-        raise # Re-raise to allow tenacity to retry
-    except RetryError as e_retry: # If tenacity gives up
-        logger.error(f"API call {func.__name__} failed after multiple retries: {e_retry}", exc_info=True)
-        return None, {'code': -2, 'msg': f"API call failed after retries: {e_retry}"}
+    except httpx.RequestError as e: # Specific to httpx; already retried by _call_with_retry
+        logger.error("API call %s failed after %d attempts: %s", func.__name__, API_CALL_ATTEMPTS, e)
+        return None, {'code': -2, 'msg': f"API call failed after retries: {e}"}
     except Exception as e:
         logger.error(f"Unexpected exception during API call {func.__name__}: {e}", exc_info=True)
         return None, {'code': -1, 'msg': str(e)}
 
 class RateLimiter:
-    """Simple asyncio rate limiter."""
+    """Token-bucket asyncio rate limiter: bursts of up to calls_per_interval, refilled at
+    calls_per_interval / interval_seconds tokens per second."""
     def __init__(self, calls_per_interval: float, interval_seconds: float = 1.0):
         self.calls_per_interval = calls_per_interval
         self.interval_seconds = interval_seconds
-        self._semaphore = asyncio.Semaphore(int(calls_per_interval)) # Allow this many concurrent calls within an interval logic
-        self._timestamps: List[float] = []
+        self._rate = calls_per_interval / interval_seconds
+        self._tokens = float(calls_per_interval)
+        self._last = time.monotonic()
 
     async def acquire(self):
-        await self._semaphore.acquire()
-        current_time = time.monotonic()
-        
-        # Remove timestamps older than the interval
-        self._timestamps = [t for t in self._timestamps if current_time - t < self.interval_seconds]
-        
-        if len(self._timestamps) >= self.calls_per_interval:
-            # Calculate time to wait until the oldest call in the window expires
-            wait_time = (self._timestamps[0] + self.interval_seconds) - current_time
-            if wait_time > 0:
-                logger.debug(f"RateLimiter: Waiting {wait_time:.3f}s to respect rate limit ({self.calls_per_interval}/{self.interval_seconds}s).")
-                await asyncio.sleep(wait_time)
-                # Re-check after sleep
-                current_time = time.monotonic()
-                self._timestamps = [t for t in self._timestamps if current_time - t < self.interval_seconds]
-
-        self._timestamps.append(current_time)
-        # The semaphore release is implicit when the context is exited if used as `async with limiter:`
-        # If used as `await limiter.acquire()`, a corresponding `limiter.release()` is needed.
-        # For simple acquire-before-call, this is okay, but semaphore might not be the best primitive here.
-        # A token bucket or leaky bucket might be more accurate for "X calls per Y seconds".
-        # For now, this provides some basic control.
-
-    def release(self): # If using semaphore explicitly
-        self._semaphore.release()
+        now = time.monotonic()
+        self._tokens = min(self.calls_per_interval, self._tokens + (now - self._last) * self._rate) - 1
+        self._last = now
+        if self._tokens < 0:
+            # Negative balance reserves our slot, so concurrent waiters queue up behind us instead of all waking together
+            wait_time = -self._tokens / self._rate
+            logger.debug("RateLimiter: Waiting %.3fs to respect rate limit (%s/%ss).", wait_time, self.calls_per_interval, self.interval_seconds)
+            await asyncio.sleep(wait_time)
+
+    def release(self): # Kept for callers pairing acquire/release; the bucket needs no explicit release
+        pass
+
+class WindowRateLimiter:
+    """Strict sliding-window asyncio rate limiter: never more than calls_per_interval acquires in any interval_seconds.
+    Alternative to the token-bucket RateLimiter; the last calls_per_interval slot times live in a fixed
+    array('d') ring, so acquire() allocates nothing."""
+    def __init__(self, calls_per_interval: int, interval_seconds: float = 1.0):
+        self.calls_per_interval = int(calls_per_interval)
+        self.interval_seconds = interval_seconds
+        self._buf = array.array('d', [float('-inf')] * self.calls_per_interval) # Ring of granted slot times
+        self._head = 0 # Oldest slot, i.e. the one the next acquire replaces
+
+    async def acquire(self):
+        now = time.monotonic()
+        # The slot is reserved before sleeping, so concurrent waiters line up one window apart
+        start = max(now, self._buf[self._head] + self.interval_seconds)
+        self._buf[self._head] = start
+        self._head = (self._head + 1) % self.calls_per_interval
+        if start > now:
+            logger.debug("WindowRateLimiter: Waiting %.3fs to respect rate limit (%s/%ss).", start - now, self.calls_per_interval, self.interval_seconds)
+            await asyncio.sleep(start - now)
+
+    def release(self): # Kept for callers pairing acquire/release; the window needs no explicit release
+        pass
+
+def write_json_atomic(path: str, payload: Any):
+    """Writes payload as JSON via a temp file + os.replace, so readers never see a half-written file.
+    A payload of None removes the file instead."""
+    if payload is None:
+        if os.path.exists(path):
+            os.remove(path)
+            logger.info(f"Removed state file as it's now empty: {path}")
+        return
+    tmp_path = path + ".tmp"
+    if orjson is not None:
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+    else:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(payload, f, indent=4)
+    os.replace(tmp_path, path)
+
+class StateFileWriter:
+    """Writes JSON state files on a background daemon thread so the event loop never blocks on disk I/O.
+    Payloads must already be JSON-serializable snapshots; the thread is (re)started lazily on enqueue."""
+    def __init__(self, name: str = "StateFileWriter"):
+        self._name = name
+        self._queue: "queue.Queue[Optional[Tuple[str, Any]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, path: str, payload: Any):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            self._queue.put((path, payload))
+
+    def flush_and_join(self, timeout: float = 5.0) -> bool:
+        """Blocks until every queued write is done and the thread exits. Returns False if it timed out."""
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return True
+            self._queue.put(None) # Sentinel: stop after draining what is already queued
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.warning(f"{self._name}: pending writes not finished after {timeout}s.")
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                with self._lock: # Exit only if nothing was enqueued behind the sentinel; enqueue() restarts us otherwise
+                    if self._queue.empty():
+                        self._thread = None
+                        return
+                continue
+            path, payload = item
+            try:
+                write_json_atomic(path, payload)
+                logger.debug(f"{self._name}: wrote {path}")
+            except (IOError, OSError) as e:
+                logger.error(f"{self._name}: failed to write {path}: {e}", exc_info=True)
+            except TypeError as e:
+                logger.error(f"{self._name}: payload for {path} is not JSON-serializable: {e}", exc_info=True)
+            except Exception as e: # Keep the writer thread alive no matter what
+                logger.error(f"{self._name}: unexpected error writing {path}: {e}", exc_info=True)
 
 # Global rate limiter instances (adjust rates based on actual API limits)
 # Bybit's V5 API limits are more complex (e.g., 120 requests/second for some, 10/second for others)
 # This simple limiter might not be sufficient for all endpoints.
 # It's better to apply specific limiters per endpoint group if needed.
-bybit_rate_limiter = RateLimiter(calls_per_interval=10, interval_seconds=1.0) # Example: 10 calls/sec overall
+bybit_rate_limiter = WindowRateLimiter(calls_per_interval=10, interval_seconds=1.0) # Example: 10 calls/sec overall; Bybit counts per window, so no bursts past it
 telegram_rate_limiter = RateLimiter(calls_per_interval=20, interval_seconds=1.0) # Example: 20 calls/sec
 
 # Example of how validate_online_key might look if it were still in utils.py